@@ -1,10 +1,16 @@
 import os
+import hashlib
 import logging
 from datetime import datetime
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import Optional
 from ses_eml_save.main import (upload_to_supabase, 
+                               upload_batch_to_supabase,
+                               BatchEmailRequest,
+                               BATCH_MAX_ITEMS,
                                update_receipt, 
                                UpdateReceiptRequest, 
                                get_receipt,
@@ -12,6 +18,12 @@ from ses_eml_save.main import (upload_to_supabase,
                                delete_receipt,
                                DeleteReceiptRequest
 )
+from ses_eml_save.job_queue import submit_job, get_job, start_workers, stop_workers, QueueFullError
+from ses_eml_save.async_clients import close_http_client
+from ses_eml_save.browser_pool import start_browser_pool, stop_browser_pool
+from ses_eml_save.cpu_pool import shutdown_cpu_pool
+from ses_eml_save.metrics import snapshot as metrics_snapshot
+from ses_eml_save.ocr_cache import hit_ratio as ocr_cache_hit_ratio
 
 
 
@@ -30,7 +42,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_browser_pool()
+    await start_workers()
+    yield
+    await stop_workers()
+    await stop_browser_pool()
+    await close_http_client()
+    shutdown_cpu_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/health")
 async def health_check():
@@ -38,21 +60,71 @@ async def health_check():
     logger.info("Health check requested")
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
-# 拉取 S3 并转发给supabase
-@app.post("/webhook/ses-email-transfer")
+@app.get("/metrics")
+async def get_metrics():
+    """处理过程中的计数器（附件过滤等）"""
+    return {"metrics": metrics_snapshot(), "ocr_cache_hit_ratio": ocr_cache_hit_ratio(), "status": "success"}
+
+# 拉取 S3 并转发给supabase（入队后立即返回，由后台 worker 处理）
+@app.post("/webhook/ses-email-transfer", status_code=202)
 async def ses_email_transfer(bucket, key, user_id):
     logger.info("Received webhook request")
     bucket = str(bucket)
     key = str(key)
     user_id = str(user_id)
     try:
-        logger.info(f"Starting upload process for bucket: {bucket}, key: {key}, user_id: {user_id}")
-        result = await upload_to_supabase(bucket, key, user_id)
-        logger.info(f"Upload process completed: {result}")
-        return {"message": "Email processed successfully", "result": result, "status": "success"}
+        logger.info(f"Queueing upload process for bucket: {bucket}, key: {key}, user_id: {user_id}")
+        job, duplicate = submit_job(
+            "ses-email-transfer",
+            {"bucket": bucket, "key": key, "user_id": user_id},
+            lambda job: upload_to_supabase(bucket, key, user_id, job=job),
+            dedupe_key=f"{bucket}/{key}/{user_id}",
+        )
+        return {"message": "Email queued for processing", "job_id": job["id"], "duplicate": duplicate, "status": "accepted"}
+    except QueueFullError as e:
+        logger.error(f"Failed to queue upload process: {str(e)}")
+        return JSONResponse(status_code=503, content={"error": str(e), "status": "error"})
+    except Exception as e:
+        logger.exception(f"Failed to queue upload process: {str(e)}")
+        return JSONResponse(status_code=500, content={"error": f"Failed to queue upload process: {str(e)}", "status": "error"})
+
+
+# 批量拉取多个 S3 邮件（整批作为一个后台任务，结果按 key 返回）
+@app.post("/webhook/ses-email-transfer/batch", status_code=202)
+async def ses_email_transfer_batch(request: BatchEmailRequest):
+    logger.info(f"Received batch webhook request with {len(request.items)} items")
+    if not request.items:
+        return JSONResponse(status_code=400, content={"error": "items cannot be empty", "status": "error"})
+    # 同一批内重复的 bucket/key/user_id 只处理一次
+    items = list({f"{item.bucket}/{item.key}/{item.user_id}": item for item in request.items}.items())
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(status_code=413, content={"error": f"Too many items: {len(items)} > {BATCH_MAX_ITEMS}", "status": "error"})
+    # 重试同一批邮件时返回已有任务：去重键为排序后各邮件键的哈希
+    batch_hash = hashlib.sha256("\n".join(sorted(name for name, _ in items)).encode("utf-8")).hexdigest()
+    items = [item for _, item in items]
+    try:
+        job, duplicate = submit_job(
+            "ses-email-transfer-batch",
+            {"count": len(items)},
+            lambda job: upload_batch_to_supabase(items, job=job),
+            dedupe_key=f"batch/{batch_hash}",
+        )
+        return {"message": f"Batch of {len(items)} emails queued for processing", "job_id": job["id"], "duplicate": duplicate, "status": "accepted"}
+    except QueueFullError as e:
+        logger.error(f"Failed to queue batch: {str(e)}")
+        return JSONResponse(status_code=503, content={"error": str(e), "status": "error"})
     except Exception as e:
-        logger.exception(f"Upload process failed: {str(e)}")
-        return {"error": f"Upload process failed: {str(e)}", "status": "error"}
+        logger.exception(f"Failed to queue batch: {str(e)}")
+        return JSONResponse(status_code=500, content={"error": f"Failed to queue batch: {str(e)}", "status": "error"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """查询后台任务状态及每个文件的处理进度"""
+    job = get_job(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": f"Job {job_id} not found", "status": "error"})
+    return {"job": job, "status": "success"}
 
 
 @app.post("/webhook/update_receipt")
@@ -0,0 +1,108 @@
+"""发票链接提取基准测试
+
+用法：
+    python benchmarks/bench_link_extraction.py [语料目录] [--repeat 20]
+
+语料目录下的 *.html / *.htm 文件按 HTML 正文读取，*.eml 文件先按主流程解析出正文。
+若安装了 beautifulsoup4，会同时跑旧的 BeautifulSoup 实现作对比，并检查两者结果是否一致。
+无论是否提供语料，都会跑一组构造的恶意输入（大量未闭合的 <a 等），耗时应与输入长度成线性。
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ses_eml_save.link_extractor import extract_pdf_invoice_urls
+from ses_eml_save.eml_parser import parse_eml, close_attachments
+
+
+def load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.lower().endswith((".html", ".htm")):
+            with open(path, encoding="utf-8", errors="replace") as f:
+                corpus.append((name, f.read()))
+        elif name.lower().endswith(".eml"):
+            with open(path, "rb") as f:
+                mail = parse_eml(f)
+            close_attachments(mail["attachments"])
+            # 与主流程一致：使用解析器给出的正文
+            corpus.append((name, mail["body"]))
+    return corpus
+
+
+def bs4_extract(html_str):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_str, "html.parser")
+    links = soup.find_all("a", string=lambda text: text and "Download PDF invoice" in text)
+    return [link["href"] for link in links if link.has_attr("href")]
+
+
+def bench(name, func, corpus, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _, html_str in corpus:
+            func(html_str)
+        timings.append(time.perf_counter() - start)
+    total_bytes = sum(len(html_str) for _, html_str in corpus)
+    median = statistics.median(timings)
+    print(f"{name:<16} median {median * 1000:9.2f} ms / corpus   "
+          f"{median * 1e6 / len(corpus):9.1f} us / body   {total_bytes / median / 1e6:8.1f} MB/s")
+    return median
+
+
+def pathological_corpus(size=600_000):
+    """攻击者可控的正文：未闭合的 <a、只有末尾一个 >、超长属性、大量未闭合锚文本"""
+    return [
+        ("unclosed_a", "<a " * (size // 3) + "download pdf invoice"),
+        ("single_gt_at_end", "<a " * (size // 3) + "> download pdf invoice"),
+        ("long_attrs", '<a href="https://x/invoice.pdf" ' + "x" * size + "> download pdf invoice"),
+        ("unclosed_anchor_text", '<a href="https://x/invoice.pdf">Download PDF invoice ' * (size // 50)),
+        ("bare_lt", "<" * size + "<a download pdf invoice"),
+    ]
+
+
+def bench_pathological(repeat):
+    print("pathological inputs:")
+    for name, html_str in pathological_corpus():
+        bench(name, extract_pdf_invoice_urls, [(name, html_str)], repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark invoice link extraction")
+    parser.add_argument("corpus", nargs="?", help="directory of .html/.htm/.eml files")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    bench_pathological(min(args.repeat, 5))
+    if not args.corpus:
+        return
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        sys.exit(f"No .html/.htm/.eml files found in {args.corpus}")
+    print(f"{len(corpus)} bodies, {sum(len(h) for _, h in corpus) / 1e6:.2f} MB, repeat {args.repeat}")
+
+    fast = bench("link_extractor", extract_pdf_invoice_urls, corpus, args.repeat)
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        print("beautifulsoup4 not installed, skipping baseline")
+        return
+
+    slow = bench("beautifulsoup", bs4_extract, corpus, args.repeat)
+    print(f"speedup: {slow / fast:.1f}x")
+    for name, html_str in corpus:
+        baseline = bs4_extract(html_str)
+        missing = [url for url in baseline if url not in extract_pdf_invoice_urls(html_str)]
+        if missing:
+            print(f"MISMATCH {name}: baseline found {missing}")
+
+
+if __name__ == "__main__":
+    main()
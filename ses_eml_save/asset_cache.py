@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+from ses_eml_save.async_clients import get_http_client
+from ses_eml_save.util import env_list
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+# 渲染正文时的请求拦截：屏蔽追踪像素、字体等，图片/CSS 经本地磁盘缓存获取
+RENDER_BLOCK_RESOURCES = (os.getenv("RENDER_BLOCK_RESOURCES") or "true").lower() == "true"
+RENDER_BLOCKED_TYPES = set(env_list("RENDER_BLOCKED_TYPES", "font,media,websocket,eventsource,manifest,texttrack,script,xhr,fetch"))
+RENDER_BLOCKED_HOSTS = env_list(
+    "RENDER_BLOCKED_HOSTS",
+    "doubleclick.net,google-analytics.com,googletagmanager.com,facebook.com,facebook.net,"
+    "list-manage.com,mailchimp.com,sendgrid.net,mandrillapp.com,mailgun.org,hubspotlinks.com,"
+    "hs-analytics.net,pardot.com,exacttarget.com,sailthru.com,klaviyo.com,braze.com,"
+    "customer.io,mixpanel.com,segment.io,bat.bing.com,fonts.googleapis.com,fonts.gstatic.com"
+)
+RENDER_BLOCKED_PATH_WORDS = env_list("RENDER_BLOCKED_PATH_WORDS", "/open,/track,/pixel,/beacon,/wf/open,open.aspx,open.php")
+RENDER_ASSET_TIMEOUT = float(os.getenv("RENDER_ASSET_TIMEOUT") or 3)
+RENDER_ASSET_MAX_BYTES = int(os.getenv("RENDER_ASSET_MAX_BYTES") or 2 * 1024 * 1024)
+RENDER_ASSET_CACHE_DIR = os.getenv("RENDER_ASSET_CACHE_DIR") or "cache/render_assets"
+RENDER_ASSET_CACHE_TTL = int(os.getenv("RENDER_ASSET_CACHE_TTL") or 7 * 86400)
+RENDER_ASSET_CACHE_MAX_BYTES = int(os.getenv("RENDER_ASSET_CACHE_MAX_BYTES") or 200 * 1024 * 1024)
+
+# 只有这些类型走缓存，其余未屏蔽的请求（如 document）交给浏览器自己处理
+_CACHEABLE_TYPES = {"image", "stylesheet"}
+_PRUNE_EVERY = 200
+
+_writes_since_prune = 0
+
+
+def _is_blocked(url: str, resource_type: str) -> bool:
+    if resource_type in RENDER_BLOCKED_TYPES:
+        return True
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if any(host == blocked or host.endswith("." + blocked) for blocked in RENDER_BLOCKED_HOSTS):
+        return True
+    path = parts.path.lower()
+    return any(word in path for word in RENDER_BLOCKED_PATH_WORDS)
+
+
+def _cache_paths(url: str):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    directory = os.path.join(RENDER_ASSET_CACHE_DIR, key[:2])
+    return os.path.join(directory, key), os.path.join(directory, key + ".json")
+
+
+def _cache_get(url: str):
+    body_path, meta_path = _cache_paths(url)
+    try:
+        if time.time() - os.path.getmtime(meta_path) > RENDER_ASSET_CACHE_TTL:
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            return meta["content_type"], f.read()
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _prune_cache():
+    """缓存目录超过上限时按修改时间删除最旧的条目"""
+    entries = []
+    total = 0
+    for root, _, names in os.walk(RENDER_ASSET_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= RENDER_ASSET_CACHE_MAX_BYTES:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        if total <= RENDER_ASSET_CACHE_MAX_BYTES * 0.8:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    logger.info(f"Pruned render asset cache to {total} bytes")
+
+
+def _cache_put(url: str, content_type: str, body: bytes):
+    global _writes_since_prune
+    body_path, meta_path = _cache_paths(url)
+    os.makedirs(os.path.dirname(body_path), exist_ok=True)
+    # 先写临时文件再改名，避免并发读到半截内容；meta 最后写，作为条目完成的标志
+    for path, data, mode in ((body_path, body, "wb"), (meta_path, json.dumps({"url": url, "content_type": content_type}), "w")):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    _writes_since_prune += 1
+    if _writes_since_prune >= _PRUNE_EVERY:
+        _writes_since_prune = 0
+        _prune_cache()
+
+
+async def _fetch(url: str):
+    """带超时和大小上限地获取外部资源，失败返回 None"""
+    try:
+        async with get_http_client().stream("GET", url, follow_redirects=True, timeout=RENDER_ASSET_TIMEOUT) as response:
+            if response.status_code != 200:
+                return None
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > RENDER_ASSET_MAX_BYTES:
+                    return None
+                chunks.append(chunk)
+            content_type = response.headers.get("content-type", "application/octet-stream")
+            return content_type, b"".join(chunks)
+    except Exception as e:
+        logger.info(f"Render asset fetch failed for {url}: {str(e)}")
+        return None
+
+
+async def _fetch_within_deadline(url: str):
+    try:
+        return await asyncio.wait_for(_fetch(url), RENDER_ASSET_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.info(f"Render asset fetch timed out for {url}")
+        return None
+
+
+async def route_request(route):
+    """Playwright 路由处理：屏蔽 / 命中磁盘缓存 / 限时抓取并写入缓存"""
+    request = route.request
+    url = request.url
+    if not url.startswith(("http://", "https://")):
+        await route.continue_()
+        return
+
+    if _is_blocked(url, request.resource_type):
+        metrics.incr("render_requests_blocked")
+        await route.abort()
+        return
+
+    if request.method != "GET" or request.resource_type not in _CACHEABLE_TYPES:
+        await route.continue_()
+        return
+
+    cached = await asyncio.to_thread(_cache_get, url)
+    if cached:
+        metrics.incr("render_asset_cache_hits")
+    else:
+        metrics.incr("render_asset_cache_misses")
+        cached = await _fetch_within_deadline(url)
+        if cached is None:
+            await route.abort()
+            return
+        try:
+            await asyncio.to_thread(_cache_put, url, *cached)
+        except Exception as e:
+            logger.warning(f"Failed to cache render asset {url}: {str(e)}")
+
+    content_type, body = cached
+    await route.fulfill(status=200, content_type=content_type, body=body)
@@ -0,0 +1,184 @@
+import os
+import logging
+from urllib.parse import quote
+import httpx
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SUPABASE_URL = (os.getenv("SUPABASE_URL") or "").rstrip("/")
+SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
+SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
+
+# 共享连接池配置
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS") or 100)
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE") or 20)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT") or 60)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT") or 300)
+
+STORAGE_URL = f"{SUPABASE_URL}/storage/v1"
+REST_URL = f"{SUPABASE_URL}/rest/v1"
+
+_http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """进程内共享的异步 HTTP 客户端（keep-alive 连接池）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        )
+        logger.info(f"Created shared HTTP client, max_connections: {HTTP_MAX_CONNECTIONS}")
+    return _http_client
+
+
+async def close_http_client():
+    """在应用关闭时释放连接池"""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+        logger.info("Shared HTTP client closed")
+    _http_client = None
+
+
+def _supabase_headers(extra: dict = None) -> dict:
+    headers = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+    }
+    if extra:
+        headers.update(extra)
+    return headers
+
+
+def _object_path(bucket: str, path: str) -> str:
+    return f"{quote(bucket)}/{quote(path.lstrip('/'))}"
+
+
+async def storage_upload(path: str, data: bytes, content_type: str = "application/octet-stream", bucket: str = SUPABASE_BUCKET, upsert: bool = False):
+    """上传文件到 Supabase Storage"""
+    response = await get_http_client().post(
+        f"{STORAGE_URL}/object/{_object_path(bucket, path)}",
+        content=data,
+        headers=_supabase_headers({
+            "content-type": content_type,
+            "cache-control": "max-age=3600",
+            "x-upsert": "true" if upsert else "false",
+        }),
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def storage_create_signed_url(path: str, expires_in: int = 86400, bucket: str = SUPABASE_BUCKET) -> str:
+    """生成单个文件的签名 URL"""
+    response = await get_http_client().post(
+        f"{STORAGE_URL}/object/sign/{_object_path(bucket, path)}",
+        json={"expiresIn": expires_in},
+        headers=_supabase_headers(),
+    )
+    response.raise_for_status()
+    return f"{STORAGE_URL}{response.json()['signedURL']}"
+
+
+async def storage_create_signed_urls(paths: list, expires_in: int = 86400, bucket: str = SUPABASE_BUCKET) -> dict:
+    """一次请求批量生成签名 URL，返回 {path: signed_url}，失败的路径对应 None"""
+    if not paths:
+        return {}
+    response = await get_http_client().post(
+        f"{STORAGE_URL}/object/sign/{quote(bucket)}",
+        json={"expiresIn": expires_in, "paths": list(paths)},
+        headers=_supabase_headers(),
+    )
+    response.raise_for_status()
+    return {
+        item["path"]: f"{STORAGE_URL}{item['signedURL']}" if item.get("signedURL") else None
+        for item in response.json()
+    }
+
+
+async def storage_download(path: str, bucket: str = SUPABASE_BUCKET) -> bytes:
+    """从 Supabase Storage 下载文件"""
+    response = await get_http_client().get(
+        f"{STORAGE_URL}/object/authenticated/{_object_path(bucket, path)}",
+        headers=_supabase_headers(),
+    )
+    response.raise_for_status()
+    return response.content
+
+
+async def table_insert(table: str, row: dict) -> list:
+    """通过 PostgREST 插入一行数据"""
+    response = await get_http_client().post(
+        f"{REST_URL}/{table}",
+        json=row,
+        headers=_supabase_headers({"Prefer": "return=representation"}),
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def _filter_params(filters: dict) -> dict:
+    """等值条件转为 PostgREST 查询参数，列表值转为 in 条件"""
+    params = {}
+    for field, value in filters.items():
+        if isinstance(value, (list, tuple, set)):
+            params[field] = f"in.({','.join(str(item) for item in value)})"
+        else:
+            params[field] = f"eq.{value}"
+    return params
+
+
+async def table_select(table: str, filters: dict, columns: str = "*", limit: int = None, offset: int = None, order: str = None) -> list:
+    """通过 PostgREST 按条件查询，列表值按 in 匹配；order 形如 create_time.desc"""
+    params = {"select": columns}
+    params.update(_filter_params(filters))
+    if order:
+        params["order"] = order
+    if limit:
+        params["limit"] = str(limit)
+    if offset:
+        params["offset"] = str(offset)
+    response = await get_http_client().get(f"{REST_URL}/{table}", params=params, headers=_supabase_headers())
+    response.raise_for_status()
+    return response.json()
+
+
+async def table_update(table: str, filters: dict, row: dict) -> list:
+    """通过 PostgREST 按条件更新，返回更新后的行"""
+    response = await get_http_client().patch(
+        f"{REST_URL}/{table}",
+        params=_filter_params(filters),
+        json=row,
+        headers=_supabase_headers({"Prefer": "return=representation"}),
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def table_delete(table: str, filters: dict) -> list:
+    """通过 PostgREST 按条件删除，返回被删除的行"""
+    response = await get_http_client().delete(
+        f"{REST_URL}/{table}",
+        params=_filter_params(filters),
+        headers=_supabase_headers({"Prefer": "return=representation"}),
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def table_upsert(table: str, row: dict, on_conflict: str) -> list:
+    """通过 PostgREST 插入或按唯一键合并一行数据"""
+    response = await get_http_client().post(
+        f"{REST_URL}/{table}",
+        params={"on_conflict": on_conflict},
+        json=row,
+        headers=_supabase_headers({"Prefer": "resolution=merge-duplicates,return=representation"}),
+    )
+    response.raise_for_status()
+    return response.json()
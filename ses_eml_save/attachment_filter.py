@@ -0,0 +1,165 @@
+import os
+import struct
+import logging
+import mimetypes
+from fnmatch import fnmatch
+from collections import Counter
+from dotenv import load_dotenv
+from ses_eml_save.util import env_list, read_head
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+# 允许/拒绝的 MIME 类型（支持 image/* 这样的通配符），拒绝列表优先
+ATTACHMENT_ALLOWED_MIME = env_list("ATTACHMENT_ALLOWED_MIME", "application/pdf,image/*")
+ATTACHMENT_DENIED_MIME = env_list(
+    "ATTACHMENT_DENIED_MIME",
+    "text/calendar,application/ics,application/pkcs7-signature,application/x-pkcs7-signature,"
+    "application/pgp-signature,text/vcard,text/x-vcard,image/svg+xml"
+)
+ATTACHMENT_MIN_BYTES = int(os.getenv("ATTACHMENT_MIN_BYTES") or 1024)
+IMAGE_MIN_WIDTH = int(os.getenv("IMAGE_MIN_WIDTH") or 200)
+IMAGE_MIN_HEIGHT = int(os.getenv("IMAGE_MIN_HEIGHT") or 200)
+
+SNIFF_BYTES = 64 * 1024
+
+# 文件头魔数 -> MIME 类型
+_MAGIC = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"BM", "image/bmp"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"BEGIN:VCALENDAR", "text/calendar"),
+    (b"BEGIN:VCARD", "text/vcard"),
+]
+
+
+def sniff_content_type(head: bytes):
+    """根据文件头魔数判断真实类型，无法识别时返回 None"""
+    for magic, content_type in _MAGIC:
+        if head.startswith(magic):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    # PDF 允许文件头前有少量垃圾字节
+    if b"%PDF-" in head[:1024]:
+        return "application/pdf"
+    return None
+
+
+def _jpeg_dimensions(head: bytes):
+    i = 2
+    while i + 9 < len(head):
+        if head[i] != 0xFF:
+            i += 1
+            continue
+        marker = head[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        if marker == 0xDA:
+            return None
+        length = struct.unpack(">H", head[i + 2:i + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", head[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def image_dimensions(head: bytes, content_type: str):
+    """从文件头解析图片宽高，无法解析时返回 None"""
+    try:
+        if content_type == "image/png" and len(head) >= 24:
+            return struct.unpack(">II", head[16:24])
+        if content_type == "image/gif" and len(head) >= 10:
+            return struct.unpack("<HH", head[6:10])
+        if content_type == "image/bmp" and len(head) >= 26:
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height)
+        if content_type == "image/jpeg":
+            return _jpeg_dimensions(head)
+        if content_type == "image/webp" and len(head) >= 30:
+            chunk = head[12:16]
+            if chunk == b"VP8X":
+                width = int.from_bytes(head[24:27], "little") + 1
+                height = int.from_bytes(head[27:30], "little") + 1
+                return width, height
+            if chunk == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", head[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+    except struct.error:
+        return None
+    return None
+
+
+def _matches(content_type: str, patterns) -> bool:
+    return any(fnmatch(content_type, pattern) for pattern in patterns)
+
+
+def classify_attachment(att: dict):
+    """判断附件是否可能是发票，返回 (是否保留, 原因, 实际类型)"""
+    head = read_head(att["binary"], SNIFF_BYTES)
+    size = att.get("size")
+    if size is None:
+        size = len(att["binary"]) if isinstance(att["binary"], (bytes, bytearray)) else len(head)
+
+    declared = (att.get("content_type") or "application/octet-stream").lower()
+    if declared == "application/octet-stream":
+        declared = mimetypes.guess_type(att.get("filename") or "")[0] or declared
+    content_type = sniff_content_type(head) or declared
+
+    if size < ATTACHMENT_MIN_BYTES:
+        return False, "too_small", content_type
+    if _matches(content_type, ATTACHMENT_DENIED_MIME):
+        return False, "denied_type", content_type
+    if not _matches(content_type, ATTACHMENT_ALLOWED_MIME):
+        return False, "not_allowed_type", content_type
+    if content_type.startswith("image/"):
+        dimensions = image_dimensions(head, content_type)
+        if dimensions and (dimensions[0] < IMAGE_MIN_WIDTH or dimensions[1] < IMAGE_MIN_HEIGHT):
+            return False, "small_image", content_type
+    return True, "kept", content_type
+
+
+def filter_attachments(attachments):
+    """过滤掉签名图、追踪像素、日历邀请等明显不是发票的附件
+
+    返回 (保留的附件, 被跳过的 [(附件, 原因)])，保留附件的 content_type
+    会被修正为嗅探出的真实类型。
+    """
+    kept = []
+    skipped = []
+    reasons = Counter()
+    for att in attachments:
+        try:
+            keep, reason, content_type = classify_attachment(att)
+        except Exception as e:
+            logger.warning(f"Failed to classify attachment {att.get('filename')}, keeping it: {str(e)}")
+            keep, reason, content_type = True, "kept", att.get("content_type")
+
+        reasons[reason] += 1
+        metrics.incr(f"attachments_{reason}" if keep else f"attachments_skipped_{reason}")
+        if keep:
+            att["content_type"] = content_type
+            kept.append(att)
+        else:
+            logger.info(f"Skipping attachment {att.get('filename')} ({content_type}): {reason}")
+            skipped.append((att, reason))
+
+    logger.info(f"Attachment filter kept {len(kept)}/{len(attachments)} attachments, reasons: {dict(reasons)}")
+    return kept, skipped
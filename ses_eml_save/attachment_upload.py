@@ -1,64 +1,41 @@
 import os
-import base64
 import logging
+import mimetypes
 from datetime import datetime
 from dotenv import load_dotenv
-from supabase import create_client, Client
 from ses_eml_save.util import make_safe_storage_path
+from ses_eml_save.async_clients import storage_upload, storage_create_signed_urls
+from ses_eml_save.concurrency import stage_limit
 
 
 load_dotenv()
 
-SUPABASE_URL = os.getenv("SUPABASE_URL") or ""
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
 
 logger = logging.getLogger(__name__)
 
-def upload_attachments_to_storage(attachments, user_id, bucket=SUPABASE_BUCKET):
-    logger.info(f"Starting attachment upload process for {len(attachments)} attachments to bucket: {bucket}")
-
-    records = {}
-    for i, att in enumerate(attachments, 1):
-        try:
-            filename = att["filename"]
-            logger.info(f"Processing attachment {i}/{len(attachments)}: {filename}")
-            
-            safe_filename = make_safe_storage_path(filename)
-            logger.info(f"Safe filename generated: {safe_filename}")
-            
-            binary = att["binary"]
-            if isinstance(binary, bytes):
-                binary_data = base64.b64decode(binary)
-                logger.info(f"Decoded base64 binary data, size: {len(binary_data)} bytes")
-            else:
-                binary_data = binary  # 已经是 bytes
-                logger.info(f"Binary data already in bytes format, size: {len(binary_data)} bytes")
-
-            date_url = datetime.utcnow().date().isoformat()
-            timestamp = datetime.utcnow().isoformat()
-            storage_path = f"users/{user_id}/{date_url}/{timestamp}_{safe_filename}"
-            logger.info(f"Generated storage path: {storage_path}")
-
-            logger.info(f"Uploading {filename} to storage at {storage_path}")
-            supabase.storage.from_(bucket).upload(
-                path=storage_path,
-                file=binary_data,
-                file_options={"content-type": att.get("content_type", "application/octet-stream")}
-            )
-
-            # 获取签名URL（24小时有效期）
-            signed_url_result = supabase.storage.from_(SUPABASE_BUCKET).create_signed_url(storage_path, expires_in=86400)
-            public_url = signed_url_result["signedURL"]
-            #public_url = supabase.storage.from_(bucket).get_public_url(storage_path).rstrip('?')
-            #logger.info(f"Upload successful. Public URL: {public_url}")
-            #records[filename] = public_url
-            records[filename] = [public_url,storage_path]
-        
-        except Exception as e:
-            logger.exception(f"Failed to upload attachment {i}/{len(attachments)}: {att.get('filename', 'unknown')} - Error: {str(e)}")
-            raise
-    
-    logger.info(f"Attachment upload process completed. Successfully uploaded {len(records)}/{len(attachments)} attachments")
-    return records
\ No newline at end of file
+def build_attachment_storage_path(filename, user_id, content_type=None):
+    """生成附件的存储路径，文件名没有后缀时按 content_type 补全"""
+    safe_filename = make_safe_storage_path(filename)
+    if "." not in safe_filename and content_type:
+        safe_filename += mimetypes.guess_extension(content_type) or ""
+    logger.info(f"Safe filename generated: {safe_filename}")
+
+    date_url = datetime.utcnow().date().isoformat()
+    timestamp = datetime.utcnow().isoformat()
+    storage_path = f"users/{user_id}/{date_url}/{timestamp}_{safe_filename}"
+    logger.info(f"Generated storage path: {storage_path}")
+    return storage_path
+
+async def upload_file_to_storage(storage_path, binary_data, content_type="application/octet-stream", bucket=SUPABASE_BUCKET, upsert=False):
+    """上传单个文件（受全局 upload 并发上限约束），返回存储路径"""
+    async with stage_limit("upload"):
+        logger.info(f"Uploading {len(binary_data)} bytes to storage at {storage_path}")
+        await storage_upload(storage_path, binary_data, content_type=content_type, bucket=bucket, upsert=upsert)
+    return storage_path
+
+async def sign_storage_paths(paths, bucket=SUPABASE_BUCKET):
+    """一次请求为一批存储路径生成签名URL（24小时有效期）"""
+    signed_urls = await storage_create_signed_urls(paths, expires_in=86400, bucket=bucket)
+    logger.info(f"Generated {len(signed_urls)} signed URLs in one request")
+    return signed_urls
@@ -0,0 +1,63 @@
+import os
+import hashlib
+import logging
+import mimetypes
+from datetime import datetime
+from typing import Optional
+from dotenv import load_dotenv
+from ses_eml_save.async_clients import table_select, table_upsert
+from ses_eml_save.encryption import encrypt_data, decrypt_data
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 按内容哈希存储附件，并通过索引表复用已上传文件及其 OCR/字段提取结果
+BLOB_DEDUPE_ENABLED = (os.getenv("BLOB_DEDUPE_ENABLED") or "true").lower() == "true"
+BLOB_INDEX_TABLE = "attachment_blobs_en"
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def build_blob_storage_path(user_id: str, sha256: str, content_type: Optional[str] = None) -> str:
+    """内容寻址的存储路径：相同内容总是落在同一路径"""
+    ext = mimetypes.guess_extension(content_type) if content_type else None
+    return f"users/{user_id}/blobs/{sha256[:2]}/{sha256}{ext or ''}"
+
+
+async def lookup_blob(user_id: str, sha256: str) -> Optional[dict]:
+    """查询该用户是否已处理过相同内容的附件，命中时返回解密后的索引记录"""
+    try:
+        rows = await table_select(BLOB_INDEX_TABLE, {"user_id": user_id, "sha256": sha256}, limit=1)
+    except Exception as e:
+        logger.warning(f"Blob index lookup failed for {sha256}: {str(e)}")
+        return None
+
+    if not rows:
+        metrics.incr("blob_index_misses")
+        return None
+    metrics.incr("blob_index_hits")
+    logger.info(f"Blob index hit for {sha256}: {rows[0].get('storage_path')}")
+    return decrypt_data(BLOB_INDEX_TABLE, rows[0])
+
+
+async def record_blob(user_id: str, sha256: str, storage_path: str, size: int, ocr: str, fields: str):
+    """记录已处理附件的存储路径和 OCR/字段提取结果，失败时只记录警告"""
+    row = {
+        "user_id": user_id,
+        "sha256": sha256,
+        "storage_path": storage_path,
+        "size": size,
+        "ocr": ocr,
+        "fields": fields,
+        "create_time": datetime.utcnow().isoformat(),
+    }
+    try:
+        await table_upsert(BLOB_INDEX_TABLE, encrypt_data(BLOB_INDEX_TABLE, row), on_conflict="user_id,sha256")
+        logger.info(f"Recorded blob {sha256} at {storage_path}")
+    except Exception as e:
+        logger.warning(f"Failed to record blob {sha256}: {str(e)}")
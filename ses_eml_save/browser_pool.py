@@ -0,0 +1,164 @@
+import os
+import asyncio
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Optional
+from dotenv import load_dotenv
+from playwright.async_api import async_playwright
+from ses_eml_save.asset_cache import route_request, RENDER_BLOCK_RESOURCES
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 常驻 Chromium：页面池大小即渲染并发上限；页面/浏览器渲染到一定次数后回收，防止内存持续增长
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE") or 2)
+BROWSER_PAGE_RECYCLE_AFTER = int(os.getenv("BROWSER_PAGE_RECYCLE_AFTER") or 50)
+BROWSER_RECYCLE_AFTER = int(os.getenv("BROWSER_RECYCLE_AFTER") or 500)
+BROWSER_PREWARM = (os.getenv("BROWSER_PREWARM") or "true").lower() == "true"
+BROWSER_LAUNCH_ARGS = ["--disable-dev-shm-usage", "--disable-gpu"]
+
+_playwright = None
+_browser = None
+_browser_renders = 0
+# 每个浏览器实例上仍存活的页面数，被替换的旧浏览器在最后一个页面关闭时关闭
+_browser_pages: Counter = Counter()
+_slots: Optional[asyncio.Queue] = None
+_launch_lock: Optional[asyncio.Lock] = None
+
+
+async def _close_browser(browser):
+    try:
+        await browser.close()
+        logger.info("Closed retired Chromium browser")
+    except Exception as e:
+        logger.warning(f"Failed to close Chromium browser: {str(e)}")
+
+
+async def _current_browser():
+    """返回可用的浏览器；未启动、已断开或达到回收次数时重新启动"""
+    global _playwright, _browser, _browser_renders
+    async with _launch_lock:
+        healthy = _browser is not None and _browser.is_connected()
+        if healthy and _browser_renders < BROWSER_RECYCLE_AFTER:
+            return _browser
+
+        if _browser is not None:
+            logger.info(f"Recycling Chromium browser (connected: {healthy}, renders: {_browser_renders})")
+            retired = _browser
+            _browser = None
+            if not _browser_pages[retired]:
+                _browser_pages.pop(retired, None)
+                await _close_browser(retired)
+
+        if _playwright is None:
+            _playwright = await async_playwright().start()
+        logger.info("Launching Chromium browser")
+        _browser = await _playwright.chromium.launch(args=BROWSER_LAUNCH_ARGS)
+        _browser_renders = 0
+        metrics.incr("browser_launches")
+        return _browser
+
+
+async def _open_slot() -> dict:
+    browser = await _current_browser()
+    context = await browser.new_context()
+    if RENDER_BLOCK_RESOURCES:
+        await context.route("**/*", route_request)
+    page = await context.new_page()
+    _browser_pages[browser] += 1
+    return {"browser": browser, "context": context, "page": page, "renders": 0}
+
+
+async def _discard_slot(slot: dict):
+    """关闭页面所在的 context；所属浏览器已被替换且没有其他页面时一并关闭"""
+    browser = slot["browser"]
+    try:
+        await slot["context"].close()
+    except Exception as e:
+        logger.warning(f"Failed to close browser context: {str(e)}")
+    _browser_pages[browser] -= 1
+    if _browser_pages[browser] <= 0:
+        _browser_pages.pop(browser, None)
+        if browser is not _browser:
+            await _close_browser(browser)
+
+
+def _slot_healthy(slot: dict) -> bool:
+    return (slot["browser"] is _browser
+            and slot["browser"].is_connected()
+            and not slot["page"].is_closed()
+            and slot["renders"] < BROWSER_PAGE_RECYCLE_AFTER)
+
+
+@asynccontextmanager
+async def browser_page():
+    """从池中借出一个页面，池满时等待；渲染出错的页面直接丢弃，下次借出时重建"""
+    global _browser_renders
+    if _slots is None:
+        # 未经 FastAPI lifespan 启动（如脚本直接调用）时按需创建
+        await start_browser_pool()
+
+    slots = _slots
+    slot = await slots.get()
+    try:
+        if slot is not None and not _slot_healthy(slot):
+            metrics.incr("browser_page_recycles")
+            await _discard_slot(slot)
+            slot = None
+        if slot is None:
+            slot = await _open_slot()
+
+        try:
+            yield slot["page"]
+        except BaseException:
+            await _discard_slot(slot)
+            slot = None
+            raise
+        slot["renders"] += 1
+        _browser_renders += 1
+        metrics.incr("browser_renders")
+    finally:
+        slots.put_nowait(slot)
+
+
+async def start_browser_pool(size: int = BROWSER_POOL_SIZE):
+    """在应用启动时创建页面池，并预先启动浏览器（失败时推迟到第一次渲染）"""
+    global _slots, _launch_lock
+    if _slots is not None:
+        return
+    _launch_lock = asyncio.Lock()
+    _slots = asyncio.Queue()
+    for _ in range(size):
+        _slots.put_nowait(None)
+    logger.info(f"Browser pool started, size: {size}")
+
+    if BROWSER_PREWARM:
+        try:
+            await _current_browser()
+        except Exception as e:
+            logger.exception(f"Failed to prewarm Chromium, will retry on first render: {str(e)}")
+
+
+async def stop_browser_pool():
+    """在应用关闭时关闭所有页面、浏览器和 Playwright"""
+    global _slots, _playwright, _browser
+    if _slots is None:
+        return
+    while not _slots.empty():
+        slot = _slots.get_nowait()
+        if slot is not None:
+            await _discard_slot(slot)
+    _slots = None
+
+    if _browser is not None:
+        await _close_browser(_browser)
+        _browser = None
+    _browser_pages.clear()
+    if _playwright is not None:
+        await _playwright.stop()
+        _playwright = None
+    logger.info("Browser pool stopped")
@@ -0,0 +1,31 @@
+import os
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 各处理阶段在整个进程内的并发上限，单封邮件和批量任务共享
+STAGE_LIMITS = {
+    "s3": int(os.getenv("S3_CONCURRENCY") or 16),
+    "parse": int(os.getenv("PARSE_CONCURRENCY") or 4),
+    "upload": int(os.getenv("UPLOAD_CONCURRENCY") or 16),
+    "ocr": int(os.getenv("OCR_CONCURRENCY") or 8),
+    # 大 PDF 按页分块并发 OCR，单独限流（在文件级 ocr 限流内部获取，不能共用同一个信号量）
+    "ocr_chunk": int(os.getenv("PDF_OCR_CHUNK_CONCURRENCY") or 8),
+}
+
+_semaphores: dict = {}
+
+
+def stage_limit(stage: str) -> asyncio.Semaphore:
+    """返回指定阶段的共享信号量（首次使用时创建）"""
+    semaphore = _semaphores.get(stage)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(STAGE_LIMITS[stage])
+        _semaphores[stage] = semaphore
+        logger.info(f"Created concurrency limit for stage {stage}: {STAGE_LIMITS[stage]}")
+    return semaphore
@@ -0,0 +1,40 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# CPU 密集任务（PDF 文本提取、图片预处理）使用的进程池；设为 0 时退化为线程执行
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS") or min(4, os.cpu_count() or 1))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS)
+        logger.info(f"Created CPU process pool, workers: {CPU_POOL_WORKERS}")
+    return _executor
+
+
+async def run_cpu(func, *args):
+    """在进程池中执行 CPU 密集函数（func 和参数必须可 pickle）"""
+    if CPU_POOL_WORKERS <= 0:
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+
+
+def shutdown_cpu_pool():
+    """在应用关闭时结束工作进程"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+        logger.info("CPU process pool shut down")
@@ -1,6 +1,17 @@
 import os
+import io
+import re
 import boto3
+import base64
+import binascii
+import tempfile
+import mimetypes
+import threading
 import mailparser
+from email import policy
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from botocore.config import Config
 from dotenv import load_dotenv
 import logging
 
@@ -14,27 +25,81 @@ AWS_REGION = os.getenv("AWS_REGION")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 
+# S3 连接池与流式读取配置
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS") or 50)
+S3_READ_CHUNK_SIZE = int(os.getenv("S3_READ_CHUNK_SIZE") or 1024 * 1024)
+S3_MAX_EML_BYTES = int(os.getenv("S3_MAX_EML_BYTES") or 50 * 1024 * 1024)
+S3_SPOOL_MAX_MEMORY = int(os.getenv("S3_SPOOL_MAX_MEMORY") or 8 * 1024 * 1024)
 
-def load_s3(bucket, key):
-    logger.info(f"Loading object from S3: bucket={bucket}, key={key}")
+# 邮件解析模式：stream（逐个解码附件到临时文件）或 mailparser（一次性解析）
+EML_PARSE_MODE = os.getenv("EML_PARSE_MODE") or "stream"
+# 单个附件留在内存中的上限，超过后落盘
+ATTACHMENT_SPOOL_MAX_MEMORY = int(os.getenv("ATTACHMENT_SPOOL_MAX_MEMORY") or 1024 * 1024)
+# 单封邮件所有附件留在内存中的总预算，用完后后续附件直接写入磁盘
+ATTACHMENT_MEMORY_BUDGET = int(os.getenv("ATTACHMENT_MEMORY_BUDGET") or 8 * 1024 * 1024)
+# 流式读取时单次 readline 的最大字节数，避免超长行一次性读入内存
+EML_MAX_LINE = 64 * 1024
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """进程内共享的 S3 client（boto3 client 线程安全，可被多个线程复用）"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client(
+                    "s3",
+                    region_name=AWS_REGION,
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        retries={"max_attempts": 3, "mode": "standard"}
+                    )
+                )
+                logger.info(f"Created shared S3 client, max_pool_connections: {S3_MAX_POOL_CONNECTIONS}")
+    return _s3_client
+
+
+def _check_size(size, bucket, key):
+    if size > S3_MAX_EML_BYTES:
+        raise ValueError(f"S3 object {bucket}/{key} exceeds size limit: {size} > {S3_MAX_EML_BYTES} bytes")
+
+
+def load_s3_stream(bucket, key):
+    """分块读取 S3 对象到临时文件对象
+
+    小于 S3_SPOOL_MAX_MEMORY 的邮件保留在内存中，超过后自动落盘；
+    超过 S3_MAX_EML_BYTES 直接拒绝。调用方负责 close()。
+    """
+    logger.info(f"Streaming object from S3: bucket={bucket}, key={key}")
+    spool = tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_MAX_MEMORY)
     try:
-        s3 = boto3.client(
-            "s3",
-            region_name=AWS_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        )
-        response = s3.get_object(Bucket=bucket, Key=key)
-        logger.info("S3 object loaded successfully.")
-        return response["Body"].read()
+        response = get_s3_client().get_object(Bucket=bucket, Key=key)
+        _check_size(response.get("ContentLength") or 0, bucket, key)
+
+        size = 0
+        for chunk in response["Body"].iter_chunks(S3_READ_CHUNK_SIZE):
+            size += len(chunk)
+            _check_size(size, bucket, key)
+            spool.write(chunk)
+        spool.seek(0)
+        logger.info(f"S3 object streamed successfully, size: {size} bytes, spilled to disk: {size > S3_SPOOL_MAX_MEMORY}")
+        return spool
     except Exception as e:
-        logger.exception(f"Failed to load object from S3: {str(e)}")
+        spool.close()
+        logger.exception(f"Failed to stream object from S3: {str(e)}")
         raise
 
 
 def mail_parser(eml_bytes):
     logger.info("Parsing EML bytes.")
     try:
+        if hasattr(eml_bytes, "read"):
+            eml_bytes = eml_bytes.read()
         mail = mailparser.parse_from_bytes(eml_bytes)
 
         # 基本字段提取
@@ -49,7 +114,9 @@ def mail_parser(eml_bytes):
             filename = att.get("filename", "unknown")
             content_type = att.get("mail_content_type", "application/octet-stream")
             payload = att.get("payload", b"")
-            if isinstance(payload, str):
+            if att.get("binary"):
+                payload = base64.b64decode(payload)
+            elif isinstance(payload, str):
                 payload = payload.encode("utf-8")
 
             raw_attachments.append({
@@ -70,3 +137,258 @@ def mail_parser(eml_bytes):
         logger.exception(f"Failed to parse EML bytes: {str(e)}")
         raise
 
+
+class _LineReader:
+    """按行读取二进制文件，支持回退一行"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pushed = None
+        self.at_line_start = True
+
+    def readline(self):
+        if self.pushed is not None:
+            line, self.pushed = self.pushed, None
+        else:
+            line = self.fp.readline(EML_MAX_LINE)
+        # 超长行被截断时，后续片段不是行首，不能当作 boundary 判断
+        self.line_start, self.at_line_start = self.at_line_start, line.endswith(b"\n")
+        return line
+
+    def push(self, line):
+        self.pushed = line
+        self.at_line_start = self.line_start
+
+
+def _match_boundary(reader, line, boundaries):
+    """判断一行是否为 boundary，返回 (boundary, is_close) 或 None"""
+    if not boundaries or not reader.line_start or not line.startswith(b"--"):
+        return None
+    stripped = line.rstrip()
+    for boundary in reversed(boundaries):
+        if stripped == b"--" + boundary:
+            return boundary, False
+        if stripped == b"--" + boundary + b"--":
+            return boundary, True
+    return None
+
+
+def _skip_until_boundary(reader, boundaries):
+    while True:
+        line = reader.readline()
+        if not line:
+            return None
+        match = _match_boundary(reader, line, boundaries)
+        if match:
+            return match
+
+
+def _read_headers(reader, boundaries):
+    lines = []
+    while True:
+        line = reader.readline()
+        if not line or line in (b"\r\n", b"\n"):
+            break
+        if _match_boundary(reader, line, boundaries):
+            reader.push(line)
+            break
+        lines.append(line)
+    return BytesHeaderParser(policy=policy.default).parsebytes(b"".join(lines))
+
+
+def _split_eol(line):
+    if line.endswith(b"\r\n"):
+        return line[:-2], b"\r\n"
+    if line.endswith(b"\n"):
+        return line[:-1], b"\n"
+    return line, b""
+
+
+_BASE64_JUNK = re.compile(rb"[^A-Za-z0-9+/=]")
+
+
+def _is_body_part(headers):
+    return (
+        headers.get_content_type() in ("text/plain", "text/html")
+        and headers.get_content_disposition() != "attachment"
+        and not headers.get_filename()
+    )
+
+
+def _new_attachment_sink(budget):
+    if budget["remaining"] > 0:
+        return tempfile.SpooledTemporaryFile(max_size=min(ATTACHMENT_SPOOL_MAX_MEMORY, budget["remaining"]))
+    return tempfile.TemporaryFile()
+
+
+def _read_leaf(reader, headers, boundaries, budget, embedded=False):
+    """把一个叶子节点的内容边读边解码写入 sink，返回 (part, 结束它的 boundary)
+
+    embedded 为 True 时节点位于转发的内层邮件中，其正文按附件处理，不作为外层邮件正文。
+    """
+    is_body = not embedded and _is_body_part(headers)
+    sink = io.BytesIO() if is_body else _new_attachment_sink(budget)
+    encoding = str(headers.get("Content-Transfer-Encoding", "")).strip().lower()
+
+    size = 0
+    pending_eol = b""
+    b64_buffer = b""
+    match = None
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        match = _match_boundary(reader, line, boundaries)
+        if match:
+            break
+
+        if encoding == "base64":
+            b64_buffer += _BASE64_JUNK.sub(b"", line)
+            usable = len(b64_buffer) // 4 * 4
+            if usable:
+                chunk = binascii.a2b_base64(b64_buffer[:usable])
+                b64_buffer = b64_buffer[usable:]
+            else:
+                chunk = b""
+        else:
+            # boundary 前的换行属于 boundary，因此换行延迟到下一行再写入
+            content, eol = _split_eol(line)
+            if encoding == "quoted-printable":
+                if content.endswith(b"=") and eol:
+                    content, eol = content[:-1], b""
+                content = binascii.a2b_qp(content)
+            chunk = pending_eol + content
+            pending_eol = eol
+
+        if chunk:
+            sink.write(chunk)
+            size += len(chunk)
+
+    if b64_buffer:
+        chunk = binascii.a2b_base64(b64_buffer + b"=" * (-len(b64_buffer) % 4))
+        sink.write(chunk)
+        size += len(chunk)
+
+    sink.seek(0)
+    if not is_body and isinstance(sink, tempfile.SpooledTemporaryFile):
+        if size <= ATTACHMENT_SPOOL_MAX_MEMORY and size <= budget["remaining"]:
+            budget["remaining"] -= size
+
+    content_type = headers.get_content_type()
+    filename = headers.get_filename()
+    if not filename and not is_body:
+        filename = f"unknown{mimetypes.guess_extension(content_type) or ''}"
+
+    part = {
+        "filename": filename,
+        "content_type": content_type,
+        "charset": headers.get_content_charset(),
+        "is_body": is_body,
+        "binary": sink,
+        "size": size,
+    }
+    return part, match
+
+
+def _is_embedded_message(headers):
+    """转发时作为附件的整封邮件；只有未做 base64/QP 编码时才能直接按行继续解析"""
+    encoding = str(headers.get("Content-Transfer-Encoding", "")).strip().lower()
+    return headers.get_content_type() == "message/rfc822" and encoding in ("", "7bit", "8bit", "binary")
+
+
+def _walk(reader, headers, boundaries, budget, embedded=False):
+    if _is_embedded_message(headers):
+        # 与 email.walk() 一致：读取内层邮件头后继续遍历其正文和附件
+        inner_headers = _read_headers(reader, boundaries)
+        return (yield from _walk(reader, inner_headers, boundaries, budget, embedded=True))
+
+    boundary = headers.get_param("boundary") if headers.get_content_maintype() == "multipart" else None
+    if not boundary:
+        part, match = _read_leaf(reader, headers, boundaries, budget, embedded)
+        yield part
+        return match
+
+    inner = boundaries + [str(boundary).encode("latin-1")]
+    match = _skip_until_boundary(reader, inner)
+    while match is not None and match[0] == inner[-1] and not match[1]:
+        part_headers = _read_headers(reader, inner)
+        match = yield from _walk(reader, part_headers, inner, budget, embedded)
+    if match is not None and match[0] == inner[-1]:
+        # 跳过 epilogue，直到遇到外层 boundary
+        match = _skip_until_boundary(reader, boundaries)
+    return match
+
+
+def read_mail_headers(fp):
+    """读取顶层邮件头，之后可继续调用 iter_mime_parts 读取正文和附件"""
+    return _read_headers(_LineReader(fp), [])
+
+
+def iter_mime_parts(fp, headers):
+    """逐个产出 MIME 叶子节点，附件内容边读边解码写入临时文件
+
+    每个附件最多 ATTACHMENT_SPOOL_MAX_MEMORY 字节留在内存中，且整封邮件
+    不超过 ATTACHMENT_MEMORY_BUDGET，其余全部落盘，峰值内存与附件数量无关。
+    产出的 part["binary"] 为文件对象，由调用方负责 close()。
+    """
+    budget = {"remaining": ATTACHMENT_MEMORY_BUDGET}
+    yield from _walk(_LineReader(fp), headers, [], budget)
+
+
+def _first_address(header):
+    addresses = getaddresses([str(header)]) if header else []
+    return addresses[0][1] if addresses else ""
+
+
+def mail_parser_stream(fp):
+    """流式解析邮件，返回结构与 mail_parser 相同，附件 binary 为临时文件对象"""
+    logger.info("Parsing EML stream.")
+    raw_attachments = []
+    try:
+        headers = read_mail_headers(fp)
+        text_plain = []
+        text_html = []
+
+        for part in iter_mime_parts(fp, headers):
+            if part["is_body"]:
+                try:
+                    text = part["binary"].getvalue().decode(part["charset"] or "utf-8", errors="replace")
+                except LookupError:
+                    text = part["binary"].getvalue().decode("utf-8", errors="replace")
+                (text_plain if part["content_type"] == "text/plain" else text_html).append(text)
+                continue
+            raw_attachments.append({
+                "filename": part["filename"],
+                "content_type": part["content_type"],
+                "binary": part["binary"],  # 已解码的文件对象（小附件在内存，大附件在磁盘）
+                "size": part["size"],
+            })
+
+        body = text_plain[0] if text_plain else text_html[0] if text_html else ""
+        logger.info(f"Parsed {len(raw_attachments)} attachments from EML stream.")
+        return dict(
+                from_email=_first_address(headers.get("From")),
+                to_email=_first_address(headers.get("To")),
+                subject=str(headers.get("Subject") or ""),
+                body=body,
+                attachments=raw_attachments
+            )
+    except Exception as e:
+        close_attachments(raw_attachments)
+        logger.exception(f"Failed to parse EML stream: {str(e)}")
+        raise
+
+
+def parse_eml(fp):
+    """按 EML_PARSE_MODE 选择解析方式"""
+    if EML_PARSE_MODE == "stream":
+        return mail_parser_stream(fp)
+    return mail_parser(fp)
+
+
+def close_attachments(attachments):
+    """释放附件占用的临时文件"""
+    for att in attachments or []:
+        binary = att.get("binary")
+        if hasattr(binary, "close"):
+            binary.close()
@@ -22,7 +22,10 @@ fernet = Fernet(ENCRYPTION_KEY.encode() if isinstance(ENCRYPTION_KEY, str) else
 # 需要加密的敏感字段
 SENSITIVE_FIELDS = {
     'receipt_items_en': ['buyer', 'seller', 'address', 'file_url','invoice_number','original_info','ocr'],
-    'ses_eml_info_en': ['from', 'to', 's3_eml_url','buyer', 'seller']
+    'ses_eml_info_en': ['from', 'to', 's3_eml_url','buyer', 'seller'],
+    'attachment_blobs_en': ['ocr', 'fields'],
+    'ocr_cache_en': ['ocr', 'fields'],
+    'seller_templates_en': ['template']
 }
 
 def encrypt_value(value):
@@ -0,0 +1,120 @@
+import os
+import re
+import logging
+from html.parser import HTMLParser
+from typing import Optional
+from dotenv import load_dotenv
+from ses_eml_save.ocr import extract_fields
+from ses_eml_save.util import clean_and_parse_json
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 正文文本快速路径：文本足够长且关键字段齐全时，跳过截图和视觉 OCR
+HTML_TEXT_FAST_PATH = (os.getenv("HTML_TEXT_FAST_PATH") or "true").lower() == "true"
+HTML_TEXT_MIN_CHARS = int(os.getenv("HTML_TEXT_MIN_CHARS") or 200)
+HTML_TEXT_REQUIRED_FIELDS = [
+    field.strip() for field in (os.getenv("HTML_TEXT_REQUIRED_FIELDS") or "invoice_total,invoice_date,seller").split(",")
+    if field.strip()
+]
+
+_BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "center", "dd", "div", "dl", "dt", "fieldset",
+    "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header",
+    "hr", "main", "nav", "ol", "p", "pre", "section", "table", "tbody", "tfoot", "thead", "tr", "ul",
+}
+_SKIP_TAGS = {"head", "script", "style", "title", "noscript", "template", "svg"}
+_CELL_SEPARATOR = " | "
+_TAG_PROBE = re.compile(r"<(html|body|div|table|p|br|span|td|a)\b", re.IGNORECASE)
+_SPACES = re.compile(r"[ \t\r\f\v\u00a0\u200b]+")
+
+
+class _TextExtractor(HTMLParser):
+    """把 HTML 转成保留版式的纯文本：块级元素换行，表格单元格用 | 分隔"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+        self._cell_open = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+        elif tag == "br":
+            self.parts.append("\n")
+        elif tag in ("td", "th"):
+            if self._cell_open:
+                self.parts.append(_CELL_SEPARATOR)
+            self._cell_open = True
+        elif tag == "li":
+            self.parts.append("\n- ")
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+            if tag == "tr":
+                self._cell_open = False
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in ("br", "hr"):
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in _BLOCK_TAGS or tag == "li":
+            self.parts.append("\n")
+            if tag == "tr":
+                self._cell_open = False
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(_SPACES.sub(" ", data.replace("\n", " ")))
+
+
+def looks_like_html(body: str) -> bool:
+    return bool(_TAG_PROBE.search(body or ""))
+
+
+def html_to_text(html_str: str) -> str:
+    """HTML 正文转为保留行结构的文本；本身就是纯文本时只做空白整理"""
+    if looks_like_html(html_str):
+        extractor = _TextExtractor()
+        extractor.feed(html_str)
+        extractor.close()
+        raw = "".join(extractor.parts)
+    else:
+        raw = html_str or ""
+
+    lines = (_SPACES.sub(" ", line).strip(" |") for line in raw.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def _missing_fields(fields: str) -> list:
+    try:
+        items = clean_and_parse_json(fields)
+    except Exception:
+        return list(HTML_TEXT_REQUIRED_FIELDS)
+    return [field for field in HTML_TEXT_REQUIRED_FIELDS if items.get(field) in (None, "", 0)]
+
+
+async def extract_from_html_text(html_str: str, user_id: str = None) -> Optional[tuple]:
+    """尝试直接从正文文本提取字段，成功返回 (text, fields)，需要回退到截图 + 视觉 OCR 时返回 None"""
+    text = html_to_text(html_str)
+    if len(text) < HTML_TEXT_MIN_CHARS:
+        logger.info(f"Body text too sparse ({len(text)} chars), falling back to rendering")
+        metrics.incr("html_text_fallback_sparse")
+        return None
+
+    logger.info(f"Extracting fields directly from body text ({len(text)} chars)")
+    fields, _ = await extract_fields(text, user_id)
+    missing = _missing_fields(fields)
+    if missing:
+        logger.info(f"Body text extraction missing {missing}, falling back to rendering")
+        metrics.incr("html_text_fallback_missing_fields")
+        return None
+
+    metrics.incr("html_text_fast_path")
+    return text, fields
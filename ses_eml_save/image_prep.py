@@ -0,0 +1,49 @@
+import io
+import os
+import logging
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 视觉 OCR 前的图片预处理：按 EXIF 摆正、限制长边、转灰度 JPEG，并把体积压到上限以内
+IMAGE_PREPROCESS_ENABLED = (os.getenv("IMAGE_PREPROCESS_ENABLED") or "true").lower() == "true"
+IMAGE_OCR_MAX_EDGE = int(os.getenv("IMAGE_OCR_MAX_EDGE") or 2000)
+IMAGE_OCR_GRAYSCALE = (os.getenv("IMAGE_OCR_GRAYSCALE") or "true").lower() == "true"
+IMAGE_OCR_JPEG_QUALITY = int(os.getenv("IMAGE_OCR_JPEG_QUALITY") or 80)
+IMAGE_OCR_MAX_BYTES = int(os.getenv("IMAGE_OCR_MAX_BYTES") or 1536 * 1024)
+
+_MIN_QUALITY = 50
+
+
+def _encode(image, quality: int) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def preprocess_image(data: bytes) -> tuple:
+    """返回 (处理后的字节, content_type)，在 CPU 进程池中执行
+
+    先降质量，仍超过 IMAGE_OCR_MAX_BYTES 时再按比例缩小尺寸。
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("L" if IMAGE_OCR_GRAYSCALE else "RGB")
+        image.thumbnail((IMAGE_OCR_MAX_EDGE, IMAGE_OCR_MAX_EDGE), Image.LANCZOS)
+
+        quality = IMAGE_OCR_JPEG_QUALITY
+        encoded = _encode(image, quality)
+        while len(encoded) > IMAGE_OCR_MAX_BYTES:
+            if quality > _MIN_QUALITY:
+                quality = max(_MIN_QUALITY, quality - 10)
+            else:
+                width, height = image.size
+                if max(width, height) < 400:
+                    break
+                image = image.resize((int(width * 0.75), int(height * 0.75)), Image.LANCZOS)
+            encoded = _encode(image, quality)
+    return encoded, "image/jpeg"
@@ -0,0 +1,177 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional, Callable, Awaitable, Any
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 后台 worker 数量、队列容量、已完成任务的保留时间
+JOB_WORKERS = int(os.getenv("JOB_WORKERS") or 4)
+JOB_QUEUE_MAXSIZE = int(os.getenv("JOB_QUEUE_MAXSIZE") or 1000)
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS") or 86400)
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+_jobs: dict = {}
+_dedupe_index: dict = {}
+_runners: dict = {}
+_queue: Optional[asyncio.Queue] = None
+_workers: list = []
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def _prune_finished_jobs():
+    """清理超过保留时间的已完成任务"""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    expired = [job_id for job_id, job in _jobs.items()
+               if job["state"] in (SUCCEEDED, FAILED) and job["_finished_ts"] < cutoff]
+    for job_id in expired:
+        job = _jobs.pop(job_id)
+        if _dedupe_index.get(job["dedupe_key"]) == job_id:
+            _dedupe_index.pop(job["dedupe_key"], None)
+    if expired:
+        logger.info(f"Pruned {len(expired)} expired jobs")
+
+
+def submit_job(kind: str, params: dict, runner: Callable[[dict], Awaitable[Any]], dedupe_key: Optional[str] = None) -> tuple:
+    """提交任务到队列，返回 (job, is_duplicate)
+
+    相同 dedupe_key 的任务如果还在排队、运行中或已成功，直接返回已有任务，
+    避免 SES/Lambda 超时重试导致同一封邮件被处理两次；失败的任务允许重新提交。
+    """
+    if _queue is None:
+        raise RuntimeError("Job workers are not running")
+
+    _prune_finished_jobs()
+
+    if dedupe_key:
+        existing_id = _dedupe_index.get(dedupe_key)
+        existing = _jobs.get(existing_id) if existing_id else None
+        if existing and existing["state"] != FAILED:
+            logger.info(f"Duplicate job submission for {dedupe_key}, returning existing job {existing_id}")
+            return existing, True
+
+    job_id = str(uuid.uuid4())
+    job = {
+        "id": job_id,
+        "kind": kind,
+        "state": QUEUED,
+        "stage": None,
+        "params": params,
+        "files": {},
+        "result": None,
+        "error": None,
+        "created_at": _now(),
+        "started_at": None,
+        "finished_at": None,
+        "dedupe_key": dedupe_key,
+        "_finished_ts": None,
+    }
+
+    try:
+        _queue.put_nowait(job_id)
+    except asyncio.QueueFull:
+        logger.error(f"Job queue is full ({JOB_QUEUE_MAXSIZE}), rejecting {kind} job")
+        raise QueueFullError(f"Job queue is full ({JOB_QUEUE_MAXSIZE})")
+
+    _jobs[job_id] = job
+    _runners[job_id] = runner
+    if dedupe_key:
+        _dedupe_index[dedupe_key] = job_id
+    logger.info(f"Queued {kind} job {job_id}, queue size: {_queue.qsize()}")
+    return job, False
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """返回任务的对外展示信息，不存在时返回 None"""
+    job = _jobs.get(job_id)
+    if job is None:
+        return None
+    return {k: v for k, v in job.items() if not k.startswith("_") and k != "dedupe_key"}
+
+
+def set_job_stage(job: Optional[dict], stage: str):
+    """更新任务当前所处阶段（job 为 None 时忽略）"""
+    if job is not None:
+        job["stage"] = stage
+
+
+def set_file_status(job: Optional[dict], filename: str, state: str, error: Optional[str] = None):
+    """更新任务中单个文件的处理进度（job 为 None 时忽略）"""
+    if job is None:
+        return
+    entry = job["files"].setdefault(filename, {"state": None, "error": None, "updated_at": None})
+    entry["state"] = state
+    entry["error"] = error
+    entry["updated_at"] = _now()
+
+
+async def _worker(worker_id: int):
+    logger.info(f"Job worker {worker_id} started")
+    while True:
+        job_id = await _queue.get()
+        job = _jobs.get(job_id)
+        runner = _runners.pop(job_id, None)
+        try:
+            if job is None or runner is None:
+                continue
+            logger.info(f"Worker {worker_id} picked up {job['kind']} job {job_id}")
+            job["state"] = RUNNING
+            job["started_at"] = _now()
+            try:
+                job["result"] = await runner(job)
+                job["state"] = SUCCEEDED
+                logger.info(f"Job {job_id} succeeded")
+            except asyncio.CancelledError:
+                job["state"] = FAILED
+                job["error"] = "Job cancelled during shutdown"
+                raise
+            except Exception as e:
+                logger.exception(f"Job {job_id} failed: {str(e)}")
+                job["state"] = FAILED
+                job["error"] = str(e)
+            finally:
+                job["finished_at"] = _now()
+                job["_finished_ts"] = time.time()
+        finally:
+            _queue.task_done()
+
+
+async def start_workers(workers: int = JOB_WORKERS):
+    """在应用启动时创建队列并启动后台 worker"""
+    global _queue
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue(maxsize=JOB_QUEUE_MAXSIZE)
+    for i in range(workers):
+        _workers.append(asyncio.create_task(_worker(i + 1)))
+    logger.info(f"Started {workers} job workers, queue maxsize: {JOB_QUEUE_MAXSIZE}")
+
+
+async def stop_workers():
+    """在应用关闭时取消后台 worker"""
+    global _queue
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queue = None
+    logger.info("Job workers stopped")
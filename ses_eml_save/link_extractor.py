@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import html
+import logging
+from dataclasses import dataclass
+from typing import List, Optional
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class VendorLinkPattern:
+    """一个供应商的发票链接规则：锚文本或 href 任一匹配即视为发票 PDF 链接"""
+    vendor: str
+    text: Optional[re.Pattern] = None
+    href: Optional[re.Pattern] = None
+    # 预过滤关键字（小写），正文中一个都不出现时跳过该规则
+    keywords: tuple = ()
+
+    def matches(self, text: str, href: str) -> bool:
+        return bool((self.text and self.text.search(text)) or (self.href and self.href.search(href)))
+
+
+def _pattern(vendor, text=None, href=None, keywords=()):
+    return VendorLinkPattern(
+        vendor=vendor,
+        text=re.compile(text, re.IGNORECASE) if text else None,
+        href=re.compile(href, re.IGNORECASE) if href else None,
+        keywords=tuple(keyword.lower() for keyword in keywords),
+    )
+
+
+# 内置供应商规则，模块加载时编译一次
+_VENDOR_PATTERNS: List[VendorLinkPattern] = [
+    _pattern("default", text=r"Download PDF invoice", keywords=("download pdf invoice",)),
+    _pattern("stripe", href=r"^https://(pay|invoice)\.stripe\.com/.+/pdf\b", keywords=("stripe.com",)),
+    _pattern("paddle", href=r"^https://[\w.-]*paddle\.(com|net)/.*(invoice|receipt).*\.pdf\b", keywords=("paddle.",)),
+    _pattern("aws", href=r"^https://[\w.-]*\.amazonaws\.com/.*invoice.*\.pdf\b", keywords=("amazonaws.com",)),
+    _pattern("apple", href=r"^https://[\w.-]*\.apple\.com/.*(invoice|receipt).*\.pdf\b", keywords=("apple.com",)),
+]
+
+
+def register_vendor_pattern(vendor: str, text: str = None, href: str = None, keywords=()):
+    """注册额外的供应商链接规则（锚文本/href 正则，忽略大小写）"""
+    if not text and not href:
+        raise ValueError(f"Vendor pattern {vendor} needs a text or href regex")
+    if not keywords:
+        raise ValueError(f"Vendor pattern {vendor} needs at least one prefilter keyword")
+    _VENDOR_PATTERNS.append(_pattern(vendor, text=text, href=href, keywords=keywords))
+    logger.info(f"Registered invoice link pattern for vendor: {vendor}")
+
+
+def _load_env_patterns():
+    """INVOICE_LINK_PATTERNS: {"vendor": {"text": "...", "href": "...", "keywords": ["..."]}}"""
+    raw = os.getenv("INVOICE_LINK_PATTERNS")
+    if not raw:
+        return
+    try:
+        for vendor, spec in json.loads(raw).items():
+            register_vendor_pattern(vendor, spec.get("text"), spec.get("href"), spec.get("keywords") or ())
+    except Exception as e:
+        logger.exception(f"Invalid INVOICE_LINK_PATTERNS: {str(e)}")
+        raise
+
+
+_load_env_patterns()
+
+# 锚标签分词：从每个 <a 位置用 str.find 找一次结束的 >，找不到说明后面不可能再有完整的开始标签，直接结束；
+# 锚文本截到下一个 </a 或 <a（未闭合的锚标签按自动闭合处理），各次扫描区间互不重叠，保证整体线性，不构建 DOM 树
+_MAX_ATTRS_CHARS = 4096
+_MAX_ANCHOR_TEXT_CHARS = 4096
+_ANCHOR_START_RE = re.compile(r"<a\b", re.IGNORECASE)
+_ANCHOR_END_RE = re.compile(r"</?a\b", re.IGNORECASE)
+_HREF_RE = re.compile(r"""\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]*>")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def _active_patterns(html_str: str) -> List[VendorLinkPattern]:
+    """字节级预过滤：没有锚标签或没有任何关键字时直接返回空"""
+    lowered = html_str.lower()
+    if "<a" not in lowered:
+        return []
+    return [pattern for pattern in _VENDOR_PATTERNS if any(keyword in lowered for keyword in pattern.keywords)]
+
+
+def iter_anchors(html_str: str):
+    """逐个产出 (锚文本, href)，锚文本已去标签、反转义并压缩空白"""
+    position = 0
+    while True:
+        match = _ANCHOR_START_RE.search(html_str, position)
+        if not match:
+            return
+        tag_end = html_str.find(">", match.end())
+        if tag_end < 0:
+            return
+        position = tag_end + 1
+        attrs = html_str[match.end():tag_end]
+        if len(attrs) > _MAX_ATTRS_CHARS:
+            continue
+        href_match = _HREF_RE.search(attrs)
+        if not href_match:
+            continue
+        href = html.unescape(next(group for group in href_match.groups() if group is not None)).strip()
+        limit = min(len(html_str), position + _MAX_ANCHOR_TEXT_CHARS)
+        end_match = _ANCHOR_END_RE.search(html_str, position, limit)
+        inner = html_str[position:end_match.start() if end_match else limit]
+        text = _SPACE_RE.sub(" ", html.unescape(_TAG_RE.sub(" ", inner))).strip()
+        yield text, href
+
+
+def extract_pdf_invoice_urls(html_str: str) -> List[str]:
+    """从 HTML 正文中提取发票 PDF 链接（按出现顺序去重）"""
+    logger.info("Extracting PDF invoice URLs from HTML content")
+    patterns = _active_patterns(html_str or "")
+    urls = []
+    if patterns:
+        for text, href in iter_anchors(html_str):
+            if not href.lower().startswith(("http://", "https://")) or href in urls:
+                continue
+            for pattern in patterns:
+                if pattern.matches(text, href):
+                    logger.info(f"Matched {pattern.vendor} invoice link: {href}")
+                    urls.append(href)
+                    break
+    logger.info(f"Found {len(urls)} PDF invoice URLs")
+    return urls
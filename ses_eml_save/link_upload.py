@@ -1,73 +1,108 @@
 import os
 import uuid
-import requests
+import asyncio
 import logging
-from io import BytesIO
+import tempfile
 from typing import List
+from urllib.parse import urlsplit
 from datetime import datetime
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
-from supabase import create_client, Client
+from ses_eml_save.async_clients import get_http_client
+from ses_eml_save.attachment_filter import sniff_content_type
+from ses_eml_save.util import read_head
+from ses_eml_save import metrics
 
 load_dotenv()
 
 # 设置日志
 logger = logging.getLogger(__name__)
 
-# Supabase config
-SUPABASE_URL = os.getenv("SUPABASE_URL") or ""
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
-SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
+# 发票链接下载配置
+LINK_DOWNLOAD_CONCURRENCY = int(os.getenv("LINK_DOWNLOAD_CONCURRENCY") or 4)
+LINK_PER_HOST_CONCURRENCY = int(os.getenv("LINK_PER_HOST_CONCURRENCY") or 2)
+LINK_TIMEOUT = float(os.getenv("LINK_TIMEOUT") or 15)
+LINK_DOWNLOAD_DEADLINE = float(os.getenv("LINK_DOWNLOAD_DEADLINE") or 60)
+LINK_MAX_BYTES = int(os.getenv("LINK_MAX_BYTES") or 20 * 1024 * 1024)
+LINK_SPOOL_MAX_MEMORY = int(os.getenv("LINK_SPOOL_MAX_MEMORY") or 2 * 1024 * 1024)
+LINK_CHUNK_SIZE = 64 * 1024
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+_host_semaphores: dict = {}
 
-def extract_pdf_invoice_urls(html: str) -> list[str]:
-    logger.info("Extracting PDF invoice URLs from HTML content")
-    soup = BeautifulSoup(html, "html.parser")
-    links = soup.find_all("a", string=lambda text: text and "Download PDF invoice" in text)
-    urls = [link["href"] for link in links if link.has_attr("href")]
-    logger.info(f"Found {len(urls)} PDF invoice URLs")
-    return urls
+def _host_limit(url: str) -> asyncio.Semaphore:
+    """同一主机的并发下载上限，避免单个供应商主机占满连接池"""
+    host = urlsplit(url).hostname or ""
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(LINK_PER_HOST_CONCURRENCY)
+        _host_semaphores[host] = semaphore
+    return semaphore
 
-def upload_invoice_pdf_to_supabase(pdf_urls: List[str], user_id:str, show: str) -> dict:
-    logger.info(f"Starting PDF upload process for {len(pdf_urls)} URLs with show: {show}")
-    public_urls = {}
-    
-    for i, pdf_url in enumerate(pdf_urls, 1):
-        logger.info(f"Processing PDF {i}/{len(pdf_urls)}: {pdf_url}")
-        
-        try:
-            # 下载 PDF 到内存
-            logger.info(f"Downloading PDF from: {pdf_url}")
-            response = requests.get(pdf_url)
+async def _stream_pdf(pdf_url: str):
+    """流式下载 PDF 到临时文件对象，超过 LINK_MAX_BYTES 立即中止"""
+    spool = tempfile.SpooledTemporaryFile(max_size=LINK_SPOOL_MAX_MEMORY)
+    try:
+        async with get_http_client().stream("GET", pdf_url, follow_redirects=True, timeout=LINK_TIMEOUT) as response:
             if response.status_code != 200:
-                error_msg = f"下载 PDF 失败: {response.status_code}"
-                logger.error(error_msg)
-                raise Exception(error_msg)
-            
-            logger.info(f"PDF downloaded successfully, size: {len(response.content)} bytes")
+                raise Exception(f"下载 PDF 失败: {response.status_code}")
+            content_length = int(response.headers.get("content-length") or 0)
+            if content_length > LINK_MAX_BYTES:
+                raise Exception(f"PDF too large: {content_length} > {LINK_MAX_BYTES} bytes")
+
+            size = 0
+            async for chunk in response.aiter_bytes(LINK_CHUNK_SIZE):
+                size += len(chunk)
+                if size > LINK_MAX_BYTES:
+                    raise Exception(f"PDF too large: more than {LINK_MAX_BYTES} bytes")
+                spool.write(chunk)
+
+        if sniff_content_type(read_head(spool, 1024)) != "application/pdf":
+            raise Exception("Downloaded content is not a PDF")
+        spool.seek(0)
+        return spool, size
+    except BaseException:
+        spool.close()
+        raise
 
-            id = str(uuid.uuid4())[:8]
-            filename = f"users/{user_id}/{datetime.utcnow().date().isoformat()}/eml_att_{datetime.utcnow().timestamp()}_{id}.pdf"
-            logger.info(f"Generated storage filename: {filename}")
+async def download_invoice_pdfs(pdf_urls: List[str], user_id:str, show: str) -> tuple:
+    """并发下载发票 PDF，返回 (待处理文件列表（含预先生成的存储路径）, [(失败的链接, 错误信息)])
+
+    每个链接有连接/读取超时和总时长上限，单个慢主机不会拖住整个 worker；
+    部分链接失败时返回成功的部分和失败记录，全部失败时抛出异常。
+    """
+    logger.info(f"Starting PDF download process for {len(pdf_urls)} URLs with show: {show}")
+    semaphore = asyncio.Semaphore(LINK_DOWNLOAD_CONCURRENCY)
+
+    async def download(i, pdf_url):
+        logger.info(f"Processing PDF {i}/{len(pdf_urls)}: {pdf_url}")
+        # 先占主机名额再占全局名额：等待慢主机的任务不占用全局名额，不会挡住其他主机的下载
+        async with _host_limit(pdf_url), semaphore:
+            try:
+                logger.info(f"Downloading PDF from: {pdf_url}")
+                spool, size = await asyncio.wait_for(_stream_pdf(pdf_url), LINK_DOWNLOAD_DEADLINE)
+                logger.info(f"PDF downloaded successfully, size: {size} bytes")
+                metrics.incr("link_downloads_succeeded")
+            except Exception as e:
+                metrics.incr("link_downloads_failed")
+                logger.exception(f"Failed to process PDF {i}: {pdf_url} - Error: {str(e)}")
+                raise
 
-            # 上传到 Supabase Storage
-            logger.info(f"Uploading PDF to Supabase Storage: {filename}")
-            file = BytesIO(response.content).getvalue()
-            supabase.storage.from_(SUPABASE_BUCKET).upload(file=file, path=filename, file_options={"content-type": "application/pdf"})
-            logger.info(f"PDF uploaded successfully to Supabase")
+        id = str(uuid.uuid4())[:8]
+        filename = f"users/{user_id}/{datetime.utcnow().date().isoformat()}/eml_att_{datetime.utcnow().timestamp()}_{id}.pdf"
+        logger.info(f"Generated storage filename: {filename}")
+        return {
+            "filename": f"{show}_{id}",
+            "content_type": "application/pdf",
+            "binary": spool,
+            "size": size,
+            "storage_path": filename,
+        }
 
-            # 获取 Public URL
-            signed_url_result = supabase.storage.from_(SUPABASE_BUCKET).create_signed_url(filename, expires_in=86400)
-            public_url = signed_url_result["signedURL"]
-            # public_url = supabase.storage.from_(SUPABASE_BUCKET).get_public_url(filename).rstrip('?')
-            # public_urls[f"{show}_{id}"] = public_url
-            # logger.info(f"Generated public URL: {public_urls}")
-            public_urls[f"{show}_{id}"] = [public_url,filename]
-            
-        except Exception as e:
-            logger.exception(f"Failed to process PDF {i}: {pdf_url} - Error: {str(e)}")
-            raise
+    results = await asyncio.gather(*[download(i, url) for i, url in enumerate(pdf_urls, 1)], return_exceptions=True)
+    files = [result for result in results if not isinstance(result, BaseException)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors and not files:
+        raise errors[0]
+    failures = [(url, str(result)) for url, result in zip(pdf_urls, results) if isinstance(result, BaseException)]
     
-    logger.info(f"PDF upload process completed. Total files uploaded: {len(public_urls)}")
-    return public_urls
+    logger.info(f"PDF download process completed. Total files downloaded: {len(files)}/{len(pdf_urls)}")
+    return files, failures
@@ -0,0 +1,284 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Optional
+from collections import deque
+import httpx
+from dotenv import load_dotenv
+from ses_eml_save.async_clients import get_http_client, LLM_TIMEOUT
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+MODEL = os.getenv("MODEL")
+MODEL_FREE = os.getenv("MODEL_FREE")
+OPENROUTER_URL = os.getenv("OPENROUTER_URL") or ""
+
+DEEPSEEK_URL = os.getenv("DEEPSEEK_URL") or ""
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_MODEL = "deepseek-chat"
+
+# 修改 OCR / 字段提取提示词时递增，使 OCR 结果缓存失效
+PROMPT_VERSION = 3
+
+# OCR 流水线模式：two_stage 先视觉 OCR 再由 DeepSeek 提取字段；combined 让视觉模型一次返回
+# 结构化字段（JSON Schema 输出），模型不支持或结果无法解析时自动回退到 two_stage
+OCR_PIPELINE_MODE = (os.getenv("OCR_PIPELINE_MODE") or "two_stage").lower()
+# combined 模式下是否同时要求返回原文，用于写入 ocr 列
+OCR_COMBINED_INCLUDE_TEXT = (os.getenv("OCR_COMBINED_INCLUDE_TEXT") or "true").lower() == "true"
+
+# 各模型单次请求超时：免费模型尾延迟高，超时更短，尽快回退到 MODEL
+MODEL_FREE_TIMEOUT = float(os.getenv("MODEL_FREE_TIMEOUT") or 60)
+MODEL_TIMEOUT = float(os.getenv("MODEL_TIMEOUT") or LLM_TIMEOUT)
+DEEPSEEK_TIMEOUT = float(os.getenv("DEEPSEEK_TIMEOUT") or LLM_TIMEOUT)
+
+# 重试：仅对超时、连接错误、429 和 5xx 重试，指数退避加随机抖动
+MODEL_FREE_RETRIES = int(os.getenv("MODEL_FREE_RETRIES") or 0)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES") or 2)
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY") or 0.5)
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY") or 10)
+
+# 熔断：MODEL_FREE 连续失败达到阈值后，在冷却期内直接使用 MODEL
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD") or 3)
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN") or 60)
+
+# 对冲：MODEL_FREE 超过其近期延迟的指定分位数仍未返回时，并行请求 MODEL，先成功者胜出
+LLM_HEDGE_ENABLED = (os.getenv("LLM_HEDGE_ENABLED") or "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE") or 95)
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW") or 200)
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES") or 20)
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY") or 20)
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY") or 2)
+
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json"
+}
+DEEPSEEK_HEADERS = {
+    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+_RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器：打开后冷却期内拒绝请求，冷却结束放行一次试探请求"""
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown or self._probing:
+            return False
+        # 冷却结束：半开状态，只放行一个试探请求
+        self._probing = True
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit breaker {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release_probe(self):
+        """试探请求被取消（如对冲时 MODEL 先返回）：既不算成功也不算失败，允许下一次试探"""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                metrics.incr("llm_breaker_opened")
+            logger.warning(f"Circuit breaker {self.name} open for {self.cooldown}s after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    def state(self) -> dict:
+        return {"failures": self.failures, "open": self.opened_at is not None}
+
+
+model_free_breaker = CircuitBreaker("MODEL_FREE", LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+# MODEL_FREE 最近成功请求的耗时（秒），用于计算对冲等待时间
+_model_free_latencies = deque(maxlen=LLM_HEDGE_WINDOW)
+
+
+def hedge_delay() -> float:
+    """MODEL_FREE 近期延迟的 LLM_HEDGE_PERCENTILE 分位数；样本不足时使用默认值"""
+    if len(_model_free_latencies) < LLM_HEDGE_MIN_SAMPLES:
+        return LLM_HEDGE_DEFAULT_DELAY
+    samples = sorted(_model_free_latencies)
+    index = min(len(samples) - 1, int(len(samples) * LLM_HEDGE_PERCENTILE / 100))
+    return max(LLM_HEDGE_MIN_DELAY, samples[index])
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in _RETRYABLE_STATUS
+    return isinstance(error, (httpx.TimeoutException, httpx.TransportError))
+
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """全抖动指数退避；429/503 带 Retry-After（秒）时优先使用"""
+    if isinstance(error, httpx.HTTPStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), LLM_RETRY_MAX_DELAY)
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _log_usage(label: str, model: str, response_data: dict):
+    if "usage" in response_data:
+        usage = response_data["usage"]
+        metric_label = label.lower().replace(" ", "_")
+        metrics.incr(f"llm_prompt_tokens_{metric_label}", usage.get("prompt_tokens") or 0)
+        metrics.incr(f"llm_completion_tokens_{metric_label}", usage.get("completion_tokens") or 0)
+        logger.info(f"{label} token usage ({model}) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
+                    f"Completion: {usage.get('completion_tokens', 'N/A')}, "
+                    f"Total: {usage.get('total_tokens', 'N/A')}")
+    else:
+        logger.warning(f"No usage information found in {label} response ({model})")
+
+
+async def post_chat_completion(url: str, headers: dict, payload: dict, timeout: float, retries: int, label: str) -> str:
+    """发送一次 chat completion（带重试），返回第一条回复内容"""
+    model = payload.get("model")
+    attempt = 0
+    while True:
+        try:
+            metrics.incr("llm_requests")
+            response = await get_http_client().post(url, headers=headers, json=payload, timeout=timeout)
+            response.raise_for_status()
+            response_data = response.json()
+            _log_usage(label, model, response_data)
+            logger.info(f"{label} API response ({model}): {response.status_code}")
+            return response_data["choices"][0]["message"]["content"]
+        except Exception as e:
+            if attempt >= retries or not _is_retryable(e):
+                metrics.incr("llm_failures")
+                raise
+            delay = _retry_delay(attempt, e)
+            attempt += 1
+            metrics.incr("llm_retries")
+            logger.warning(f"{label} request to {model} failed ({str(e)}), retry {attempt}/{retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+async def _call_model_free(payload: dict, label: str) -> str:
+    started = time.monotonic()
+    try:
+        content = await post_chat_completion(
+            OPENROUTER_URL, OPENROUTER_HEADERS, {**payload, "model": MODEL_FREE},
+            MODEL_FREE_TIMEOUT, MODEL_FREE_RETRIES, label,
+        )
+    except asyncio.CancelledError:
+        model_free_breaker.release_probe()
+        raise
+    except Exception as e:
+        # 只有超时、连接错误、429、5xx 说明 MODEL_FREE 不可用；400/413 等是单个请求本身的问题，不计入熔断
+        if _is_retryable(e):
+            model_free_breaker.record_failure()
+        else:
+            model_free_breaker.release_probe()
+        raise
+    model_free_breaker.record_success()
+    _model_free_latencies.append(time.monotonic() - started)
+    return content
+
+
+async def _call_model(payload: dict, label: str) -> str:
+    return await post_chat_completion(
+        OPENROUTER_URL, OPENROUTER_HEADERS, {**payload, "model": MODEL},
+        MODEL_TIMEOUT, LLM_MAX_RETRIES, label,
+    )
+
+
+class _HedgeFailed(Exception):
+    """对冲后 MODEL_FREE 和 MODEL 都失败，无需再单独回退 MODEL"""
+
+
+async def _hedged_chat(payload: dict, label: str) -> str:
+    """先发 MODEL_FREE，超过对冲等待时间仍未返回则并行发 MODEL，取先成功的结果并取消另一个"""
+    delay = hedge_delay()
+    started = time.monotonic()
+    free_task = asyncio.create_task(_call_model_free(payload, label))
+    try:
+        done, _ = await asyncio.wait({free_task}, timeout=delay)
+    except BaseException:
+        free_task.cancel()
+        raise
+    if done:
+        # MODEL_FREE 在等待时间内返回（成功或失败），失败时由调用方回退到 MODEL
+        return free_task.result()
+
+    metrics.incr("llm_hedges_fired")
+    logger.info(f"MODEL_FREE has not answered {label} within {delay:.1f}s, hedging with MODEL: {MODEL}")
+    model_task = asyncio.create_task(_call_model(payload, label))
+    pending = {free_task, model_task}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = "model_free" if task is free_task else "model"
+                    metrics.incr(f"llm_hedge_wins_{winner}")
+                    logger.info(f"Hedged {label} won by {winner}")
+                    return task.result()
+                error = task.exception()
+        raise _HedgeFailed(str(error)) from error
+    finally:
+        for task in pending:
+            task.cancel()
+        if free_task in pending:
+            # 被取消的 MODEL_FREE 按已等待时长计入样本，避免窗口里只剩快的请求而越来越频繁地对冲
+            _model_free_latencies.append(time.monotonic() - started)
+
+
+async def openrouter_chat(payload: dict, label: str = "OCR") -> str:
+    """OpenRouter 请求：先用 MODEL_FREE（熔断打开时跳过），失败后回退到 MODEL
+
+    payload 不含 model 字段，由本函数按回退顺序填入。开启 LLM_HEDGE_ENABLED 时，
+    MODEL_FREE 超过对冲等待时间仍未返回会并行请求 MODEL，先成功的结果胜出。
+    """
+    if MODEL_FREE and model_free_breaker.allow():
+        try:
+            if LLM_HEDGE_ENABLED:
+                logger.info(f"Trying {label} with MODEL_FREE: {MODEL_FREE} (hedged)")
+                return await _hedged_chat(payload, label)
+            logger.info(f"Trying {label} with MODEL_FREE: {MODEL_FREE}")
+            return await _call_model_free(payload, label)
+        except _HedgeFailed as e:
+            logger.exception(f"Both MODEL_FREE and MODEL failed for {label}: {str(e)}")
+            raise
+        except Exception as e:
+            logger.warning(f"MODEL_FREE failed, trying MODEL: {str(e)}")
+    elif MODEL_FREE:
+        metrics.incr("llm_breaker_skips")
+        logger.info(f"MODEL_FREE circuit open, using MODEL directly for {label}")
+
+    try:
+        logger.info(f"Trying {label} with MODEL: {MODEL}")
+        return await _call_model(payload, label)
+    except Exception as e:
+        logger.exception(f"Both MODEL_FREE and MODEL failed for {label}: {str(e)}")
+        raise
+
+
+async def deepseek_chat(payload: dict, label: str = "Deepseek field extraction") -> str:
+    """DeepSeek 字段提取请求（带重试）"""
+    return await post_chat_completion(DEEPSEEK_URL, DEEPSEEK_HEADERS, payload, DEEPSEEK_TIMEOUT, LLM_MAX_RETRIES, label)
@@ -4,36 +4,59 @@ import logging
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from typing import Optional, List, Any
-from supabase import create_client, Client
 from ses_eml_save.encryption import encrypt_data, decrypt_data
 from ses_eml_save.insert_data import ReceiptDataPreparer
-from ses_eml_save.eml_parser import load_s3, mail_parser
-from ses_eml_save.ocr import ocr_attachment, extract_fields_from_ocr
-from ses_eml_save.attachment_upload import upload_attachments_to_storage
-from ses_eml_save.string_to_image_upload import render_html_string_to_image_and_upload
-from ses_eml_save.link_upload import extract_pdf_invoice_urls, upload_invoice_pdf_to_supabase
+from ses_eml_save.eml_parser import load_s3_stream, parse_eml, close_attachments
+from ses_eml_save.ocr import ocr_and_extract, extract_fields
+from ses_eml_save.attachment_upload import build_attachment_storage_path, upload_file_to_storage, sign_storage_paths
+from ses_eml_save.string_to_image_upload import render_html_string_to_image
+from ses_eml_save.link_extractor import extract_pdf_invoice_urls
+from ses_eml_save.link_upload import download_invoice_pdfs
+from ses_eml_save.html_text import HTML_TEXT_FAST_PATH, extract_from_html_text, looks_like_html
+from ses_eml_save.job_queue import set_job_stage, set_file_status
+from ses_eml_save.async_clients import table_insert, table_select, table_update, table_delete
+from ses_eml_save.concurrency import stage_limit
+from ses_eml_save.attachment_filter import filter_attachments
+from ses_eml_save.util import read_binary
+from ses_eml_save.ocr_cache import OCR_CACHE_ENABLED, get_cached_ocr, put_cached_ocr
+from ses_eml_save.rule_extractor import learn_template
+from ses_eml_save import metrics
+from ses_eml_save.blob_store import BLOB_DEDUPE_ENABLED, content_hash, build_blob_storage_path, lookup_blob, record_blob
 
 
 load_dotenv()
 
-url: str = os.getenv("SUPABASE_URL") or ""
-key: str = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
-supabase: Client = create_client(url, key)
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
 
+# 单封邮件内同时进行 OCR/字段提取/入库的文件数上限
+FILE_CONCURRENCY = int(os.getenv("FILE_CONCURRENCY") or 4)
+# 批量任务中同时处理的邮件数上限
+BATCH_EMAIL_CONCURRENCY = int(os.getenv("BATCH_EMAIL_CONCURRENCY") or 8)
+# 单次批量请求允许的邮件数上限
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS") or 500)
+
 logger = logging.getLogger(__name__)
 
 
-async def upload_to_supabase(bucket, key, user_id):
+async def upload_to_supabase(bucket, key, user_id, job=None):
     logger.info(f"Starting upload_to_supabase for user_id: {user_id}, bucket: {bucket}, key: {key}")
     
+    raw_attachments = None
+    files = None
     try:
+        set_job_stage(job, "loading")
         logger.info("Loading email from S3...")
-        eml_bytes = load_s3(bucket, key)
-        logger.info(f"Successfully loaded email from S3, size: {len(eml_bytes)} bytes")
+        async with stage_limit("s3"):
+            eml_file = await asyncio.to_thread(load_s3_stream, bucket, key)
+        logger.info("Successfully loaded email from S3")
         
+        set_job_stage(job, "parsing")
         logger.info("Parsing email content...")
-        raw_attachments = mail_parser(eml_bytes)
+        try:
+            async with stage_limit("parse"):
+                raw_attachments = await asyncio.to_thread(parse_eml, eml_file)
+        finally:
+            eml_file.close()
         logger.info("Email parsing completed")
         
         html_str = raw_attachments['body']
@@ -42,66 +65,170 @@ async def upload_to_supabase(bucket, key, user_id):
         
         logger.info(f"Email subject: {subject}")
         logger.info(f"Found {len(attachments)} attachments")
+
+        # 过滤签名图、追踪像素、日历邀请等非发票附件；全部被过滤时按无附件邮件处理
+        attachments, skipped = filter_attachments(attachments)
+        for att, reason in skipped:
+            set_file_status(job, att['filename'], "skipped", reason)
         logger.info(f"HTML body length: {len(html_str)} characters")
         
-        # 处理附件或链接
+        # 收集待处理文件：附件 / PDF 链接 / HTML 正文截图，原始字节随文件一起传给 OCR
+        set_job_stage(job, "collecting")
+        link_failures = []
         if len(attachments) > 0:
             logger.info("Processing email attachments...")
-            public_urls = upload_attachments_to_storage(attachments, user_id)
-            logger.info(f"Successfully uploaded {len(public_urls)} attachments to storage")
+            files = [{
+                "filename": att["filename"],
+                "content_type": att.get("content_type", "application/octet-stream"),
+                "binary": att["binary"],
+                "storage_path": build_attachment_storage_path(att["filename"], user_id, att.get("content_type")),
+            } for att in attachments]
         else:
             logger.info("No attachments found, checking for PDF invoice links...")
-            urls = extract_pdf_invoice_urls(html_str)
+            urls = await asyncio.to_thread(extract_pdf_invoice_urls, html_str)
             if len(urls) > 0:
-                logger.info(f"Found {len(urls)} PDF invoice links, downloading and uploading...")
-                public_urls = upload_invoice_pdf_to_supabase(urls, user_id, subject)
-                logger.info(f"Successfully processed {len(public_urls)} PDF invoice links")
+                logger.info(f"Found {len(urls)} PDF invoice links, downloading...")
+                files, link_failures = await download_invoice_pdfs(urls, user_id, subject)
+                logger.info(f"Successfully downloaded {len(files)} PDF invoice links")
+                for url, error in link_failures:
+                    set_file_status(job, url, "failed", error)
             else:
-                logger.info("No PDF links found, converting HTML body to image...")
-                public_urls = await render_html_string_to_image_and_upload(html_str, user_id, subject)
-                logger.info("Successfully converted HTML body to image and uploaded")
-        
-        logger.info(f"Total files to process: {len(public_urls)}")
-        
-        # 处理每个文件的OCR和数据提取
-        successes = []
-        failures = []
-        
-        for i, (filename, public_url) in enumerate(public_urls.items(), 1):
-            logger.info(f"Processing file {i}/{len(public_urls)}: {filename}")
-            logger.info(f"public url is: {public_url[0]}")
-            logger.info(f"storage url is: {public_url[1]}")
-            try:
-                logger.info(f"Starting OCR for {filename}...")
-                ocr = ocr_attachment(public_url[1])
-                logger.info(f"OCR completed for {filename}, text length: {len(ocr)} characters")
-                
-                logger.info(f"Extracting fields from OCR for {filename}...")
-                fields = extract_fields_from_ocr(ocr)
-                logger.info(f"Field extraction completed for {filename}")
-
-                logger.info(f"Preparing data for {filename}...")
-                preparer = ReceiptDataPreparer(user_id, fields, raw_attachments, public_url[1], ocr)
-                receipt_row = preparer.build_receipt_data()
-                eml_row = preparer.build_eml_data(bucket+'/'+key)
-                logger.info(f"Data preparation completed for {filename}")
-
-                encrypted_receipt_row = encrypt_data("receipt_items_en", receipt_row)
-                encrypted_eml_row = encrypt_data("ses_eml_info_en", eml_row)
-                logger.info(f"Inserting receipt_items_en for {filename}...")
-                supabase.table("receipt_items_en").insert(encrypted_receipt_row).execute()
-                logger.info(f"Inserting ses_eml_info_en for {filename}...")
-                supabase.table("ses_eml_info_en").insert(encrypted_eml_row).execute()
-                logger.info(f"Successfully inserted data for {filename}")
+                # 正文文本快速路径：字段齐全时直接保存正文，跳过截图和视觉 OCR
+                extracted = None
+                if HTML_TEXT_FAST_PATH:
+                    try:
+                        async with stage_limit("ocr"):
+                            extracted = await extract_from_html_text(html_str, user_id)
+                    except Exception as e:
+                        # 字段提取失败不影响整封邮件，回退到截图 + 视觉 OCR
+                        metrics.incr("html_text_fallback_errors")
+                        logger.warning(f"Body text extraction failed, falling back to rendering: {str(e)}")
+                        extracted = None
+                if extracted:
+                    text, fields = extracted
+                    is_html = looks_like_html(html_str)
+                    content_type = "text/html" if is_html else "text/plain"
+                    files = [{
+                        "filename": subject,
+                        "content_type": content_type,
+                        "binary": html_str.encode("utf-8"),
+                        "storage_path": build_attachment_storage_path(f"eml_body{'.html' if is_html else '.txt'}", user_id, content_type),
+                        "ocr": text,
+                        "fields": fields,
+                    }]
+                    logger.info("Extracted fields from body text, skipping rendering")
+                else:
+                    logger.info("No PDF links found, converting HTML body to image...")
+                    files = [await render_html_string_to_image(html_str, user_id, subject)]
+                    logger.info("Successfully converted HTML body to image")
+        
+        logger.info(f"Total files to process: {len(files)}")
+        
+        # 处理每个文件：上传与 OCR/数据提取并行，两者都完成后入库
+        set_job_stage(job, "processing")
+        for file in files:
+            set_file_status(job, file["filename"], "pending")
+
+        semaphore = asyncio.Semaphore(FILE_CONCURRENCY)
+        total = len(files)
+
+        async def process_file(i, file):
+            filename = file["filename"]
+            async with semaphore:
+                logger.info(f"Processing file {i}/{total}: {filename}")
+                set_file_status(job, filename, "processing")
+                upload_task = None
+                try:
+                    data = await asyncio.to_thread(read_binary, file["binary"])
+
+                    # 内容寻址去重：同一用户已处理过相同内容时，复用存储路径和 OCR/字段提取结果
+                    sha256 = await asyncio.to_thread(content_hash, data) if BLOB_DEDUPE_ENABLED or OCR_CACHE_ENABLED else None
+                    known = await lookup_blob(user_id, sha256) if sha256 and BLOB_DEDUPE_ENABLED else None
+                    if known:
+                        logger.info(f"Duplicate content for {filename}, reusing {known['storage_path']}")
+                        storage_path = known["storage_path"]
+                        ocr = known["ocr"]
+                        fields = known["fields"]
+                    else:
+                        if sha256 and BLOB_DEDUPE_ENABLED:
+                            file["storage_path"] = build_blob_storage_path(user_id, sha256, file["content_type"])
+                        upload_task = asyncio.create_task(
+                            upload_file_to_storage(file["storage_path"], data, file["content_type"], upsert=BLOB_DEDUPE_ENABLED and bool(sha256))
+                        )
 
+                        cached = None if "fields" in file else await get_cached_ocr(sha256)
+                        if cached and not cached["ocr"]:
+                            # 没有 OCR 文本的缓存不能写入 ocr 列，也无法重新提取字段，按未命中处理
+                            cached = None
+                        if "fields" in file:
+                            # 正文文本快速路径已完成字段提取
+                            ocr = file["ocr"]
+                            fields = file["fields"]
+                        elif cached and cached["fields"]:
+                            # 相同内容此前已做过 OCR / 字段提取（可能来自其他用户或重新处理）
+                            ocr = cached["ocr"]
+                            fields = cached["fields"]
+                        elif cached:
+                            # 缓存里只有 OCR 文本（字段套用过某个用户的卖家模板），按当前用户重新提取字段
+                            ocr = cached["ocr"]
+                            async with stage_limit("ocr"):
+                                fields, _ = await extract_fields(ocr, user_id)
+                        else:
+                            async with stage_limit("ocr"):
+                                logger.info(f"Starting OCR and field extraction for {filename}...")
+                                ocr, fields, personalized = await ocr_and_extract(file["storage_path"], data, file["content_type"], file.get("tiles"), user_id)
+                                logger.info(f"Field extraction completed for {filename}")
+                            # 套用用户模板的字段含该用户的修改，只缓存 OCR 文本，避免共享给其他用户；
+                            # combined 模式未返回原文时 OCR 文本为空，不写缓存
+                            if ocr:
+                                await put_cached_ocr(sha256, ocr, "" if personalized else fields)
+
+                        storage_path = await upload_task
+                    file["storage_path"] = storage_path
+                    logger.info(f"storage url is: {storage_path}")
+
+                    logger.info(f"Preparing data for {filename}...")
+                    preparer = ReceiptDataPreparer(user_id, fields, raw_attachments, storage_path, ocr)
+                    receipt_row = preparer.build_receipt_data()
+                    eml_row = preparer.build_eml_data(bucket+'/'+key)
+                    logger.info(f"Data preparation completed for {filename}")
+
+                    encrypted_receipt_row = encrypt_data("receipt_items_en", receipt_row)
+                    encrypted_eml_row = encrypt_data("ses_eml_info_en", eml_row)
+                    logger.info(f"Inserting receipt_items_en for {filename}...")
+                    await table_insert("receipt_items_en", encrypted_receipt_row)
+                    logger.info(f"Inserting ses_eml_info_en for {filename}...")
+                    await table_insert("ses_eml_info_en", encrypted_eml_row)
+                    logger.info(f"Successfully inserted data for {filename}")
+
+                    if sha256 and BLOB_DEDUPE_ENABLED and not known:
+                        await record_blob(user_id, sha256, storage_path, len(data), ocr, fields)
+
+                    set_file_status(job, filename, "succeeded")
+                    logger.info(f"File {filename} processed successfully")
+                    return None
+                    
+                except Exception as e:
+                    if upload_task is not None and not upload_task.done():
+                        upload_task.cancel()
+                    error_msg = f"{filename} - Error: {str(e)}"
+                    logger.exception(f"Failed to process file {i}/{total}: {error_msg}")
+                    set_file_status(job, filename, "failed", str(e))
+                    return error_msg
+
+        logger.info(f"Processing {total} files with concurrency limit {FILE_CONCURRENCY}")
+        errors = await asyncio.gather(*[process_file(i, file) for i, file in enumerate(files, 1)])
+
+        # 按原始文件顺序汇总结果
+        successes = []
+        # 下载失败的发票链接也计入失败列表
+        failures = [f"{url} - Error: {error}" for url, error in link_failures]
+        for filename, error_msg in zip([file["filename"] for file in files], errors):
+            if error_msg is None:
                 successes.append(filename)
-                logger.info(f"File {filename} processed successfully")
-                
-            except Exception as e:
-                error_msg = f"{filename} - Error: {str(e)}"
-                logger.exception(f"Failed to process file {i}/{len(public_urls)}: {error_msg}")
+            else:
                 failures.append(error_msg)
-        
+
         # 生成状态报告
         total_files = len(successes) + len(failures)
         success_count = len(successes)
@@ -112,9 +239,10 @@ async def upload_to_supabase(bucket, key, user_id):
         logger.info(f"Processing summary - Total: {total_files}, Success: {success_count}, Failed: {failure_count}")
         
         # 保存上传结果
+        set_job_stage(job, "saving_result")
         try:
             logger.info("Saving upload result to database...")
-            supabase.table("receipt_items_upload_result").insert({"upload_result": status, "user_id": user_id}).execute()
+            await table_insert("receipt_items_upload_result", {"upload_result": status, "user_id": user_id})
             logger.info("Successfully saved upload result to database")
         except Exception as e:
             logger.exception(f"Failed to save upload result to database: {str(e)}")
@@ -125,6 +253,48 @@ async def upload_to_supabase(bucket, key, user_id):
     except Exception as e:
         logger.exception(f"Critical error in upload_to_supabase for user_id {user_id}: {str(e)}")
         raise
+    finally:
+        if raw_attachments:
+            close_attachments(raw_attachments['attachments'])
+        if files:
+            close_attachments(files)
+
+
+class BatchEmailItem(BaseModel):
+    bucket: str
+    key: str
+    user_id: str
+
+
+class BatchEmailRequest(BaseModel):
+    items: List[BatchEmailItem]
+
+
+async def upload_batch_to_supabase(items: List[BatchEmailItem], job=None):
+    """批量处理多封邮件，各阶段共享并发上限，返回每个 key 的处理结果"""
+    logger.info(f"Starting batch upload for {len(items)} emails with concurrency limit {BATCH_EMAIL_CONCURRENCY}")
+    semaphore = asyncio.Semaphore(BATCH_EMAIL_CONCURRENCY)
+
+    for item in items:
+        set_file_status(job, f"{item.bucket}/{item.key}", "pending")
+
+    async def process_email(item: BatchEmailItem):
+        name = f"{item.bucket}/{item.key}"
+        async with semaphore:
+            set_file_status(job, name, "processing")
+            try:
+                result = await upload_to_supabase(item.bucket, item.key, item.user_id)
+                set_file_status(job, name, "succeeded")
+                return {"bucket": item.bucket, "key": item.key, "user_id": item.user_id, "result": result, "status": "success"}
+            except Exception as e:
+                logger.exception(f"Batch item failed for {name}: {str(e)}")
+                set_file_status(job, name, "failed", str(e))
+                return {"bucket": item.bucket, "key": item.key, "user_id": item.user_id, "error": str(e), "status": "error"}
+
+    results = await asyncio.gather(*[process_email(item) for item in items])
+    success_count = sum(1 for r in results if r["status"] == "success")
+    logger.info(f"Batch upload completed - Total: {len(results)}, Success: {success_count}, Failed: {len(results) - success_count}")
+    return results
 
 
 class UpdateReceiptRequest(BaseModel):
@@ -168,21 +338,25 @@ async def update_receipt(request: UpdateReceiptRequest):
         encrypted_update_data = encrypt_data("receipt_items_en", update_data)
         
         # 执行数据库更新
-        result = supabase.table("receipt_items_en").update(encrypted_update_data).eq("ind", request.ind).eq("user_id", request.user_id).execute()
+        updated_rows = await table_update("receipt_items_en", {"ind": request.ind, "user_id": request.user_id}, encrypted_update_data)
         
-        if not result.data:
+        if not updated_rows:
             return {"error": "No matching record found or no permission to update", "status": "error"}
         
         # 解密返回数据中的敏感字段
         decrypted_result = []
-        for record in result.data:
+        for record in updated_rows:
             decrypted_record = decrypt_data("receipt_items_en", record)
             decrypted_result.append(decrypted_record)
+
+        # 用户修改/确认过的字段作为该卖家的模板，后续同一卖家的发票可直接本地提取
+        for record in decrypted_result:
+            await learn_template(request.user_id, record)
         
-        logger.info(f"Successfully updated {len(result.data)} record(s)")
+        logger.info(f"Successfully updated {len(updated_rows)} record(s)")
         return {
             "message": "Receipt information updated successfully", 
-            "updated_records": len(result.data),
+            "updated_records": len(updated_rows),
             "data": decrypted_result,
             "status": "success"
         }
@@ -204,40 +378,39 @@ async def get_receipt(request: GetReceiptRequest):
     logger.info(f"Querying receipts for user_id: {request.user_id}, ind: {request.ind}, limit: {request.limit}, offset: {request.offset}")
     
     try:
-        # 构建查询
-        query = supabase.table("receipt_items_en").select("*").eq("user_id", request.user_id)
-        
         # 如果提供了id，则精确查询
         if request.ind:
-            query = query.eq("ind", request.ind)
             logger.info(f"Exact query for record id: {request.ind}")
+            rows = await table_select("receipt_items_en", {"user_id": request.user_id, "ind": request.ind})
         else:
             # 分页查询，按create_time倒序排列
-            query = query.order("create_time", desc=True).range(request.offset, request.offset + request.limit - 1)
             logger.info(f"Paginated query with limit: {request.limit}, offset: {request.offset}, ordered by create_time desc")
-        
-        # 执行查询
-        result = query.execute()
-        
-        if not result.data:
+            rows = await table_select(
+                "receipt_items_en",
+                {"user_id": request.user_id},
+                limit=request.limit,
+                offset=request.offset,
+                order="create_time.desc",
+            )
+        
+        if not rows:
             return {"message": "No records found", "data": [], "total": 0, "status": "success"}
         
         # 解密返回数据中的敏感字段
         decrypted_result = []
-        for record in result.data:
+        for record in rows:
             decrypted_record = decrypt_data("receipt_items_en", record)
             decrypted_result.append(decrypted_record)
         
-        for record in decrypted_result:
-            if record.get("file_url"):
-                try:
-                    signed_url_result = supabase.storage.from_(SUPABASE_BUCKET).create_signed_url(
-                        record["file_url"], 
-                        expires_in=86400  # 24小时
-                    )
-                    record["file_url"] = signed_url_result.get("signedURL", record["file_url"])
-                except Exception as e:
-                    logger.warning(f"Failed to generate signed URL for {record['file_url']}: {e}")
+        # 一次请求批量生成所有记录的签名 URL（24小时）
+        file_urls = [record["file_url"] for record in decrypted_result if record.get("file_url")]
+        try:
+            signed_urls = await sign_storage_paths(file_urls)
+            for record in decrypted_result:
+                if record.get("file_url") and signed_urls.get(record["file_url"]):
+                    record["file_url"] = signed_urls[record["file_url"]]
+        except Exception as e:
+            logger.warning(f"Failed to generate signed URLs for {len(file_urls)} files: {e}")
         
         return decrypted_result
         
@@ -260,24 +433,22 @@ async def delete_receipt(request: DeleteReceiptRequest):
             return {"error": "ind list cannot be empty", "status": "error"}
         
         # 1. 先查询 receipt_items_en 表，获取对应的 id 列表
-        receipt_query_result = supabase.table("receipt_items_en").select("id, ind").eq("user_id", request.user_id).in_("ind", request.inds).execute()
+        receipt_rows = await table_select("receipt_items_en", {"user_id": request.user_id, "ind": request.inds}, columns="id,ind")
         
-        if not receipt_query_result.data:
+        if not receipt_rows:
             return {"message": "No matching records found", "deleted_count": 0, "status": "success"}
         
         # 提取 id 列表和实际找到的 ind 列表
-        found_ids = [record["id"] for record in receipt_query_result.data]
-        found_inds = [record["ind"] for record in receipt_query_result.data]
+        found_ids = [record["id"] for record in receipt_rows]
+        found_inds = [record["ind"] for record in receipt_rows]
         
         logger.info(f"Found {len(found_ids)} records to delete with ids: {found_ids}")
         
         # 2. 删除 receipt_items_en 表中的记录
-        receipt_delete_result = supabase.table("receipt_items_en").delete().eq("user_id", request.user_id).in_("ind", found_inds).execute()
-        receipt_deleted_count = len(receipt_delete_result.data) if receipt_delete_result.data else 0
+        receipt_deleted_count = len(await table_delete("receipt_items_en", {"user_id": request.user_id, "ind": found_inds}))
         
         # 3. 删除 ses_eml_info_en 表中对应的记录（根据 id 匹配）
-        eml_delete_result = supabase.table("ses_eml_info_en").delete().eq("user_id", request.user_id).in_("id", found_ids).execute()
-        eml_deleted_count = len(eml_delete_result.data) if eml_delete_result.data else 0
+        eml_deleted_count = len(await table_delete("ses_eml_info_en", {"user_id": request.user_id, "id": found_ids}))
         
         # 检查是否有未找到的 ind
         not_found_inds = list(set(request.inds) - set(found_inds))
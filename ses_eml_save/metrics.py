@@ -0,0 +1,21 @@
+import threading
+import logging
+from collections import Counter
+
+
+logger = logging.getLogger(__name__)
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def incr(name: str, value: float = 1):
+    """累加进程内计数器（线程安全）"""
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot() -> dict:
+    """返回所有计数器的当前值"""
+    with _lock:
+        return dict(sorted(_counters.items()))
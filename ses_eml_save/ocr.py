@@ -1,395 +1,378 @@
 import os
+import json
 import base64
-import requests
+import asyncio
 from dotenv import load_dotenv
-from supabase import create_client, Client
 import logging
+from ses_eml_save.async_clients import get_http_client, storage_download
+from ses_eml_save.llm_client import openrouter_chat, deepseek_chat, DEEPSEEK_MODEL, OCR_PIPELINE_MODE, OCR_COMBINED_INCLUDE_TEXT
+from ses_eml_save.cpu_pool import run_cpu
+from ses_eml_save.image_prep import IMAGE_PREPROCESS_ENABLED, preprocess_image
+from ses_eml_save.pdf_text import (PDF_TEXT_LAYER_ENABLED, PDF_OCR_CHUNK_PAGES, PDF_OCR_CHUNK_RETRIES, PDF_OCR_ENGINE,
+                                   extract_pdf_pages, count_pdf_pages, is_scanned_page, select_pdf_pages)
+from ses_eml_save.ocr_cache import get_cached_ocr, put_cached_ocr
+from ses_eml_save.blob_store import content_hash
+from ses_eml_save.util import clean_and_parse_json
+from ses_eml_save.text_compact import compact_ocr_text
+from ses_eml_save.rule_extractor import ALL_FIELDS, rule_extract
+from ses_eml_save.concurrency import stage_limit
+from ses_eml_save import metrics
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# 模型、超时、重试与 MODEL_FREE → MODEL 回退统一由 llm_client 处理
+PDF_PLUGINS = [
+    {
+        "id": "file-parser",
+        "pdf": {
+            "engine": PDF_OCR_ENGINE
+        }
+    }
+]
 
 
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-MODEL = os.getenv("MODEL")
-MODEL_FREE = os.getenv("MODEL_FREE")
-OPENROUTER_URL = os.getenv("OPENROUTER_URL") or ""
-url: str = os.getenv("SUPABASE_URL") or ""
-key: str = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
-supabase: Client = create_client(url, key)
-SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
+_FIELD_PROPERTIES = {
+    "invoice_number": {"type": ["string", "null"]},
+    "invoice_date": {"type": ["string", "null"], "description": "YYYY-MM-DD (ISO 8601)"},
+    "buyer": {"type": ["string", "null"], "description": "purchaser"},
+    "seller": {"type": ["string", "null"], "description": "vendor"},
+    "invoice_total": {"type": ["number", "null"], "description": "numeric value only, no currency symbols or commas"},
+    "currency": {"type": ["string", "null"], "description": "ISO 4217 code, e.g. USD, CNY"},
+    "category": {"type": ["string", "null"]},
+    "address": {"type": ["string", "null"]},
+}
+_FIELDS_SCHEMA = {
+    "type": "object",
+    "properties": _FIELD_PROPERTIES,
+    "required": list(_FIELD_PROPERTIES),
+    "additionalProperties": False,
+}
 
-HEADERS = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json"
+
+def _combined_response_format() -> dict:
+    properties = {"fields": _FIELDS_SCHEMA}
+    if OCR_COMBINED_INCLUDE_TEXT:
+        properties["text"] = {"type": "string", "description": "full text of the document in reading order"}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "invoice_extraction",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
     }
 
 
-def openrouter_image_ocr(file_url):
-    messages = [
+def _combined_prompt() -> str:
+    prompt = ("This is an invoice or receipt. Extract invoice_number, invoice_date (YYYY-MM-DD), buyer, seller, "
+              "invoice_total (number only), currency (e.g. USD, CNY), category and address into \"fields\"; "
+              "use null for anything not present.")
+    if OCR_COMBINED_INCLUDE_TEXT:
+        prompt += " Also transcribe the full text of the document in reading order into \"text\"."
+    return prompt + " Return only the JSON object."
+
+
+def _pdf_messages(file_content: bytes, prompt: str = None) -> list:
+    base64_pdf = base64.b64encode(file_content).decode('utf-8')
+    data_url = f"data:application/pdf;base64,{base64_pdf}"
+    return [
         {
             "role": "user",
             "content": [
                 {
                     "type": "text",
-                    "text": "What's in this image?"
+                    "text": prompt or "What are the main points in this document?"
                 },
                 {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": file_url
+                    "type": "file",
+                    "file": {
+                        "filename": "invoice.pdf",
+                        "file_data": data_url
                     }
-                }
+                },
             ]
         }
     ]
-    
-    # 先尝试使用 MODEL_FREE
-    payload = {
-        "model": MODEL_FREE,
-        "messages": messages
-    }
-    
-    try:
-        logger.info(f"Trying image OCR with MODEL_FREE: {MODEL_FREE}")
-        response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-        response.raise_for_status()
-        response_data = response.json()
-        
-        # 记录 token 使用量
-        if "usage" in response_data:
-            usage = response_data["usage"]
-            logger.info(f"Image OCR token usage (MODEL_FREE) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                       f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                       f"Total: {usage.get('total_tokens', 'N/A')}")
-        else:
-            logger.warning("No usage information found in OpenRouter response")
-        
-        logger.info(f"Image OCR API response (MODEL_FREE): {response.status_code}")
-        return response_data["choices"][0]["message"]["content"]
-        
-    except Exception as e:
-        logger.warning(f"MODEL_FREE failed, trying MODEL: {str(e)}")
-        
-        # 如果 MODEL_FREE 失败，尝试使用 MODEL
-        payload["model"] = MODEL
-        try:
-            logger.info(f"Trying image OCR with MODEL: {MODEL}")
-            response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-            response.raise_for_status()
-            response_data = response.json()
-            
-            # 记录 token 使用量
-            if "usage" in response_data:
-                usage = response_data["usage"]
-                logger.info(f"Image OCR token usage (MODEL) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                           f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                           f"Total: {usage.get('total_tokens', 'N/A')}")
-            else:
-                logger.warning("No usage information found in OpenRouter response")
-            
-            logger.info(f"Image OCR API response (MODEL): {response.status_code}")
-            return response_data["choices"][0]["message"]["content"]
-            
-        except Exception as e2:
-            logger.exception(f"Both MODEL_FREE and MODEL failed for image OCR: {str(e2)}")
-            raise
-
-def openrouter_pdf_ocr(file_url):
+
+
+def _image_messages(image_urls: list, prompt: str = None) -> list:
+    if len(image_urls) > 1:
+        slices = "These images are consecutive slices of one document, top to bottom."
+        prompt = f"{slices} {prompt}" if prompt else f"{slices} What's in it?"
+    content = [
+        {
+            "type": "text",
+            "text": prompt or "What's in this image?"
+        }
+    ]
+    for url in image_urls:
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": url
+            }
+        })
+    return [
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
+
+
+async def openrouter_image_ocr(file_url):
+    return await openrouter_chat({"messages": _image_messages([file_url])}, label="Image OCR")
+
+async def openrouter_pdf_ocr(file_url):
     logger.info(f"Starting PDF OCR for: {file_url}")
     try:
-        response = requests.get(file_url)
+        response = await get_http_client().get(file_url)
         response.raise_for_status()
-        base64_pdf = base64.b64encode(response.content).decode('utf-8')
-        data_url = f"data:application/pdf;base64,{base64_pdf}"
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "What are the main points in this document?"
-                    },
-                    {
-                        "type": "file",
-                        "file": {
-                            "filename": "invoice.pdf",
-                            "file_data": data_url
-                        }
-                    },
-                ]
-            }
-        ]
-        plugins = [
-            {
-                "id": "file-parser",
-                "pdf": {
-                    "engine": "pdf-text"  
-                }
-            }
-        ]
-        
-        # 先尝试使用 MODEL_FREE
-        payload = {
-            "model": MODEL_FREE,
-            "messages": messages,
-            "plugins": plugins
-        }
-        
-        try:
-            logger.info(f"Trying PDF OCR with MODEL_FREE: {MODEL_FREE}")
-            response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-            response.raise_for_status()
-            response_data = response.json()
-            
-            # 记录 token 使用量
-            if "usage" in response_data:
-                usage = response_data["usage"]
-                logger.info(f"PDF OCR token usage (MODEL_FREE) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                           f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                           f"Total: {usage.get('total_tokens', 'N/A')}")
-            else:
-                logger.warning("No usage information found in OpenRouter response")
-            
-            logger.info(f"PDF OCR API response (MODEL_FREE): {response.status_code}")
-            return response_data["choices"][0]["message"]["content"]
-            
-        except Exception as e:
-            logger.warning(f"MODEL_FREE failed, trying MODEL: {str(e)}")
-            
-            # 如果 MODEL_FREE 失败，尝试使用 MODEL
-            payload["model"] = MODEL
-            try:
-                logger.info(f"Trying PDF OCR with MODEL: {MODEL}")
-                response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-                response.raise_for_status()
-                response_data = response.json()
-                
-                # 记录 token 使用量
-                if "usage" in response_data:
-                    usage = response_data["usage"]
-                    logger.info(f"PDF OCR token usage (MODEL) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                               f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                               f"Total: {usage.get('total_tokens', 'N/A')}")
-                else:
-                    logger.warning("No usage information found in OpenRouter response")
-                
-                logger.info(f"PDF OCR API response (MODEL): {response.status_code}")
-                return response_data["choices"][0]["message"]["content"]
-                
-            except Exception as e2:
-                logger.exception(f"Both MODEL_FREE and MODEL failed for PDF OCR: {str(e2)}")
-                raise
-                
     except Exception as e:
         logger.exception(f"PDF OCR failed: {str(e)}")
         raise
+    return await ocr_pdf_bytes(response.content)
+
+async def ocr_attachment(file_path_or_url, data: bytes = None, content_type: str = None, tiles: list = None) -> str:
+    """对文件做 OCR；传入 data 时直接使用内存中的原始字节，不再从存储重新下载
 
-def ocr_attachment(file_path_or_url) -> str:
+    tiles 为超高正文截图切出的图块，存在时代替整图一起发给视觉模型。
+    """
     logger.info(f"Starting OCR for attachment: {file_path_or_url}")
     try:
+        if data is not None:
+            logger.info(f"Processing in-memory bytes ({len(data)} bytes, {content_type})")
+            if content_type == "application/pdf" or file_path_or_url.lower().endswith("pdf"):
+                return await ocr_pdf_bytes(data)
+            else:
+                return await ocr_image_bytes(data, content_type, tiles)
+
         # 判断是存储路径还是完整URL
         if file_path_or_url.startswith("users/") or (not file_path_or_url.startswith("http")):
             # 是存储路径，需要从Supabase下载
             logger.info(f"Processing storage path: {file_path_or_url}")
             if file_path_or_url.endswith("pdf"):
-                return ocr_pdf_from_storage(file_path_or_url)
+                return await ocr_pdf_from_storage(file_path_or_url)
             else:
-                return ocr_image_from_storage(file_path_or_url)
+                return await ocr_image_from_storage(file_path_or_url)
         else:
             # 是完整URL，使用原有逻辑
             logger.info(f"Processing URL: {file_path_or_url}")
             if file_path_or_url.endswith("pdf"):
-                return openrouter_pdf_ocr(file_path_or_url)
+                return await openrouter_pdf_ocr(file_path_or_url)
             else:
-                return openrouter_image_ocr(file_path_or_url)
+                return await openrouter_image_ocr(file_path_or_url)
     except Exception as e:
         logger.error(f"OCR failed for {file_path_or_url}: {str(e)}")
         raise
 
-def ocr_pdf_from_storage(storage_path):
+async def ocr_pdf_from_storage(storage_path):
     """直接从Supabase存储下载PDF进行OCR"""
     logger.info(f"Downloading PDF from storage: {storage_path}")
-    try:
-        # 使用Supabase client下载文件
-        file_content = supabase.storage.from_(SUPABASE_BUCKET).download(storage_path)
-        base64_pdf = base64.b64encode(file_content).decode('utf-8')
-        data_url = f"data:application/pdf;base64,{base64_pdf}"
-        
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "What are the main points in this document?"
-                    },
-                    {
-                        "type": "file",
-                        "file": {
-                            "filename": "invoice.pdf",
-                            "file_data": data_url
-                        }
-                    },
-                ]
-            }
-        ]
-        plugins = [
-            {
-                "id": "file-parser",
-                "pdf": {
-                    "engine": "pdf-text"  
-                }
-            }
-        ]
-        
-        # 先尝试使用 MODEL_FREE
-        payload = {
-            "model": MODEL_FREE,
-            "messages": messages,
-            "plugins": plugins
-        }
-        
+    file_content = await storage_download(storage_path)
+    return await ocr_pdf_bytes(file_content)
+
+def _page_label(indexes: list) -> str:
+    """indexes 为连续页（从 0 开始）"""
+    if len(indexes) == 1:
+        return str(indexes[0] + 1)
+    return f"{indexes[0] + 1}-{indexes[-1] + 1}"
+
+
+def _join_pages(texts: list) -> str:
+    """texts 为按页序排列的 (页码标签, 文本)"""
+    if len(texts) == 1:
+        return texts[0][1]
+    return "\n\n".join(f"--- Page {label} ---\n{text}" for label, text in texts)
+
+
+async def _ocr_pdf_chunk(file_content: bytes, pdf_sha256: str, chunk: list, whole_file: bool) -> str:
+    """对一组页做 OCR：先查分块缓存，失败时只重试这一块"""
+    chunk_key = content_hash(f"{pdf_sha256}:pages:{','.join(map(str, chunk))}".encode())
+    cached = await get_cached_ocr(chunk_key, metric="pdf_chunk_cache")
+    if cached:
+        return cached["ocr"]
+
+    chunk_pdf = file_content if whole_file else await run_cpu(select_pdf_pages, file_content, chunk)
+    attempt = 0
+    while True:
         try:
-            logger.info(f"Trying PDF OCR with MODEL_FREE: {MODEL_FREE}")
-            response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-            response.raise_for_status()
-            response_data = response.json()
-            
-            # 记录 token 使用量
-            if "usage" in response_data:
-                usage = response_data["usage"]
-                logger.info(f"PDF OCR token usage (MODEL_FREE) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                           f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                           f"Total: {usage.get('total_tokens', 'N/A')}")
-            else:
-                logger.warning("No usage information found in OpenRouter response")
-            
-            logger.info(f"PDF OCR API response (MODEL_FREE): {response.status_code}")
-            return response_data["choices"][0]["message"]["content"]
-            
+            async with stage_limit("ocr_chunk"):
+                text = await ocr_pdf_bytes_llm(chunk_pdf)
+            break
         except Exception as e:
-            logger.warning(f"MODEL_FREE failed, trying MODEL: {str(e)}")
-            
-            # 如果 MODEL_FREE 失败，尝试使用 MODEL
-            payload["model"] = MODEL
-            try:
-                logger.info(f"Trying PDF OCR with MODEL: {MODEL}")
-                response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-                response.raise_for_status()
-                response_data = response.json()
-                
-                # 记录 token 使用量
-                if "usage" in response_data:
-                    usage = response_data["usage"]
-                    logger.info(f"PDF OCR token usage (MODEL) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                               f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                               f"Total: {usage.get('total_tokens', 'N/A')}")
-                else:
-                    logger.warning("No usage information found in OpenRouter response")
-                
-                logger.info(f"PDF OCR API response (MODEL): {response.status_code}")
-                return response_data["choices"][0]["message"]["content"]
-                
-            except Exception as e2:
-                logger.exception(f"Both MODEL_FREE and MODEL failed for PDF OCR: {str(e2)}")
+            if attempt >= PDF_OCR_CHUNK_RETRIES:
                 raise
-                
+            attempt += 1
+            metrics.incr("pdf_chunk_retries")
+            logger.warning(f"OCR failed for PDF pages {_page_label(chunk)}, retry {attempt}/{PDF_OCR_CHUNK_RETRIES}: {str(e)}")
+
+    await put_cached_ocr(chunk_key, text, "")
+    return text
+
+
+async def _load_pdf_pages(file_content: bytes):
+    """在进程池中提取每页文本层（关闭文本层时每页都视为扫描页）；解析失败返回 None"""
+    try:
+        if PDF_TEXT_LAYER_ENABLED:
+            return await run_cpu(extract_pdf_pages, file_content)
+        return [""] * await run_cpu(count_pdf_pages, file_content)
     except Exception as e:
-        logger.exception(f"Storage PDF OCR failed: {str(e)}")
-        raise
+        metrics.incr("pdf_text_layer_failures")
+        logger.warning(f"Local PDF parsing failed, sending whole PDF to OCR: {str(e)}")
+        return None
 
-def ocr_image_from_storage(storage_path):
-    """直接从Supabase存储下载图片进行OCR"""
-    logger.info(f"Downloading image from storage: {storage_path}")
+
+async def ocr_pdf_bytes(file_content: bytes, pages: list = None):
+    """对内存中的PDF字节做OCR
+
+    优先使用本地文本层，只把扫描页/纯图片页交给 OCR 模型；需要 OCR 的页按
+    PDF_OCR_CHUNK_PAGES 分块并发请求，结果按页序拼回。已解析过的 pages 可直接传入。
+    """
+    if pages is None:
+        pages = await _load_pdf_pages(file_content)
+    if not pages:
+        return await ocr_pdf_bytes_llm(file_content)
+
+    scanned = [index for index, text in enumerate(pages) if is_scanned_page(text)]
+    if PDF_TEXT_LAYER_ENABLED:
+        metrics.incr("pdf_pages_text_layer", len(pages) - len(scanned))
+        metrics.incr("pdf_pages_scanned", len(scanned))
+        logger.info(f"PDF has {len(pages)} pages, {len(scanned)} without a usable text layer")
+    if not scanned:
+        metrics.incr("pdf_llm_ocr_skipped")
+        return _join_pages([(str(index + 1), text) for index, text in enumerate(pages)])
+
+    # 每块只含连续页，拼回时按块首页排序即可保持页序
+    runs = []
+    for index in scanned:
+        if runs and index == runs[-1][-1] + 1:
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+    chunks = [run[i:i + PDF_OCR_CHUNK_PAGES] for run in runs for i in range(0, len(run), PDF_OCR_CHUNK_PAGES)]
+    whole_file = len(chunks) == 1 and len(scanned) == len(pages)
+    if len(chunks) > 1:
+        metrics.incr("pdf_chunked_documents")
+        logger.info(f"Splitting {len(scanned)} pages into {len(chunks)} OCR chunks")
+    pdf_sha256 = await asyncio.to_thread(content_hash, file_content)
+    ocr_texts = await asyncio.gather(*[_ocr_pdf_chunk(file_content, pdf_sha256, chunk, whole_file) for chunk in chunks])
+
+    # 文本层页和 OCR 分块（连续页）按各自第一页的页序合并
+    scanned_set = set(scanned)
+    entries = [(index, str(index + 1), text) for index, text in enumerate(pages) if index not in scanned_set]
+    entries += [(chunk[0], _page_label(chunk), text) for chunk, text in zip(chunks, ocr_texts)]
+    return _join_pages([(label, text) for _, label, text in sorted(entries, key=lambda entry: entry[0])])
+
+async def ocr_pdf_bytes_llm(file_content: bytes):
+    """把PDF字节整体发给 OCR 模型"""
+    logger.info(f"Starting PDF OCR for {len(file_content)} bytes")
     try:
-        # 使用Supabase client下载文件
-        file_content = supabase.storage.from_(SUPABASE_BUCKET).download(storage_path)
-        base64_image = base64.b64encode(file_content).decode('utf-8')
-        
-        # 根据文件扩展名判断content-type
-        content_type = "image/jpeg"  # 默认
-        if storage_path.lower().endswith('.png'):
-            content_type = "image/png"
-        elif storage_path.lower().endswith(('.jpg', '.jpeg')):
-            content_type = "image/jpeg"
-        
-        data_url = f"data:{content_type};base64,{base64_image}"
-        
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "What's in this image?"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": data_url
-                        }
-                    }
-                ]
-            }
-        ]
-        
-        # 使用与原 openrouter_image_ocr 相同的逻辑
         payload = {
-            "model": MODEL_FREE,
-            "messages": messages
+            "messages": _pdf_messages(file_content),
+            "plugins": PDF_PLUGINS
         }
-        
+        return await openrouter_chat(payload, label="PDF OCR")
+    except Exception as e:
+        logger.exception(f"PDF OCR failed: {str(e)}")
+        raise
+
+async def ocr_image_from_storage(storage_path):
+    """直接从Supabase存储下载图片进行OCR"""
+    logger.info(f"Downloading image from storage: {storage_path}")
+    file_content = await storage_download(storage_path)
+
+    # 根据文件扩展名判断content-type
+    content_type = "image/jpeg"  # 默认
+    if storage_path.lower().endswith('.png'):
+        content_type = "image/png"
+    elif storage_path.lower().endswith(('.jpg', '.jpeg')):
+        content_type = "image/jpeg"
+    return await ocr_image_bytes(file_content, content_type)
+
+async def _prepare_image(data: bytes, content_type: str) -> tuple:
+    """在进程池中缩小、转灰度 JPEG，返回 (字节, content_type)；失败时原样发送"""
+    metrics.incr("image_ocr_bytes_before", len(data))
+    if IMAGE_PREPROCESS_ENABLED:
         try:
-            logger.info(f"Trying image OCR with MODEL_FREE: {MODEL_FREE}")
-            response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-            response.raise_for_status()
-            response_data = response.json()
-            
-            # 记录 token 使用量
-            if "usage" in response_data:
-                usage = response_data["usage"]
-                logger.info(f"Image OCR token usage (MODEL_FREE) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                           f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                           f"Total: {usage.get('total_tokens', 'N/A')}")
-            else:
-                logger.warning("No usage information found in OpenRouter response")
-            
-            logger.info(f"Image OCR API response (MODEL_FREE): {response.status_code}")
-            return response_data["choices"][0]["message"]["content"]
-            
+            prepared, prepared_type = await run_cpu(preprocess_image, data)
+            if len(prepared) < len(data):
+                data, content_type = prepared, prepared_type
         except Exception as e:
-            logger.warning(f"MODEL_FREE failed, trying MODEL: {str(e)}")
-            
-            # 如果 MODEL_FREE 失败，尝试使用 MODEL
-            payload["model"] = MODEL
-            try:
-                logger.info(f"Trying image OCR with MODEL: {MODEL}")
-                response = requests.post(OPENROUTER_URL, headers=HEADERS, json=payload)
-                response.raise_for_status()
-                response_data = response.json()
-                
-                # 记录 token 使用量
-                if "usage" in response_data:
-                    usage = response_data["usage"]
-                    logger.info(f"Image OCR token usage (MODEL) - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                               f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                               f"Total: {usage.get('total_tokens', 'N/A')}")
-                else:
-                    logger.warning("No usage information found in OpenRouter response")
-                
-                logger.info(f"Image OCR API response (MODEL): {response.status_code}")
-                return response_data["choices"][0]["message"]["content"]
-                
-            except Exception as e2:
-                logger.exception(f"Both MODEL_FREE and MODEL failed for image OCR: {str(e2)}")
-                raise
-                
+            metrics.incr("image_preprocess_failures")
+            logger.warning(f"Image preprocessing failed, sending original bytes: {str(e)}")
+    metrics.incr("image_ocr_bytes_after", len(data))
+    return data, content_type
+
+async def _image_data_urls(file_content: bytes, content_type: str = None, tiles: list = None) -> list:
+    images = tiles or [file_content]
+    logger.info(f"Preparing {sum(len(image) for image in images)} bytes in {len(images)} image(s) for OCR")
+    if not content_type or not content_type.startswith("image/"):
+        content_type = "image/jpeg"  # 默认
+
+    prepared = [await _prepare_image(image, content_type) for image in images]
+    return [f"data:{image_type};base64,{base64.b64encode(image).decode('utf-8')}" for image, image_type in prepared]
+
+async def ocr_image_bytes(file_content: bytes, content_type: str = None, tiles: list = None):
+    """对内存中的图片字节做OCR；传入 tiles 时按顺序发送各图块"""
+    try:
+        data_urls = await _image_data_urls(file_content, content_type, tiles)
+        return await openrouter_chat({"messages": _image_messages(data_urls)}, label="Image OCR")
     except Exception as e:
-        logger.exception(f"Storage image OCR failed: {str(e)}")
+        logger.exception(f"Image OCR failed: {str(e)}")
         raise
 
+async def _combined_ocr(data: bytes, content_type: str, tiles: list, is_pdf: bool) -> tuple:
+    """一次视觉模型调用同时完成 OCR 和字段提取，返回 (ocr 文本, 字段 JSON 字符串)"""
+    if is_pdf:
+        payload = {"messages": _pdf_messages(data, _combined_prompt()), "plugins": PDF_PLUGINS}
+    else:
+        data_urls = await _image_data_urls(data, content_type, tiles)
+        payload = {"messages": _image_messages(data_urls, _combined_prompt())}
+    # require_parameters 让 OpenRouter 只路由到支持 response_format 的提供方
+    payload["response_format"] = _combined_response_format()
+    payload["provider"] = {"require_parameters": True}
+
+    result = clean_and_parse_json(await openrouter_chat(payload, label="Combined OCR"))
+    fields = result.get("fields") if isinstance(result, dict) else None
+    if not isinstance(fields, dict):
+        raise ValueError("Combined OCR response has no fields object")
+    metrics.incr("ocr_combined_calls")
+    return result.get("text") or "", json.dumps(fields, ensure_ascii=False)
+
+
+async def ocr_and_extract(file_path_or_url, data: bytes, content_type: str = None, tiles: list = None, user_id: str = None) -> tuple:
+    """OCR 加字段提取，返回 (ocr 文本, 字段 JSON 字符串, 字段是否套用了该用户的卖家模板)
+
+    OCR_PIPELINE_MODE=combined 时先尝试单次结构化调用，失败后回退到 OCR + 字段提取两次调用；
+    有可用文本层或超过一个分块的 PDF 不需要视觉模型转写全文，仍走两阶段。
+    """
+    pages = None
+    if OCR_PIPELINE_MODE == "combined":
+        is_pdf = content_type == "application/pdf" or file_path_or_url.lower().endswith("pdf")
+        if is_pdf:
+            pages = await _load_pdf_pages(data)
+        if not (pages and (len(pages) > PDF_OCR_CHUNK_PAGES or not all(map(is_scanned_page, pages)))):
+            try:
+                return (*await _combined_ocr(data, content_type, tiles, is_pdf), False)
+            except Exception as e:
+                metrics.incr("ocr_combined_fallbacks")
+                logger.warning(f"Combined OCR failed for {file_path_or_url}, falling back to two-stage: {str(e)}")
+
+    if pages:
+        ocr = await ocr_pdf_bytes(data, pages)
+    else:
+        ocr = await ocr_attachment(file_path_or_url, data=data, content_type=content_type, tiles=tiles)
+    logger.info(f"OCR completed for {file_path_or_url}, text length: {len(ocr)} characters")
+    return (ocr, *await extract_fields(ocr, user_id))
+
 # def ocr_attachment(file_url) -> str:
 #     logger.info(f"Starting OCR for attachment: {file_url}")
 #     try:
@@ -402,49 +385,52 @@ def ocr_image_from_storage(storage_path):
 #         raise
     
 
-DEEPSEEK_URL = os.getenv("DEEPSEEK_URL") or ""
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
-DEEP_HEADERS = {
-    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-    "Content-Type": "application/json"
-}
 
+_FIELD_PROMPTS = {
+    "invoice_number": "- invoice_number: string",
+    "invoice_date": '- invoice_date: string, must be in "YYYY-MM-DD" format (ISO 8601), e.g. "2025-06-23"',
+    "buyer": "- buyer (purchaser): string",
+    "seller": "- seller (vendor): string",
+    "invoice_total": "- invoice_total: number (do not include any currency symbols, commas, or quotes, just the numeric value, e.g. 1234.56)",
+    "currency": '- currency: string (e.g. "USD", "CNY")',
+    "category": "- category: string",
+    "address": "- address: string",
+}
+_FIELD_EXAMPLE = {
+    "invoice_number": "INV-20250623-001",
+    "invoice_date": "2025-06-23",
+    "buyer": "Acme Corp",
+    "seller": "Widget Inc",
+    "invoice_total": 1234.56,
+    "currency": "USD",
+    "category": "Office Supplies",
+    "address": "123 Main St, Springfield",
+}
 
 
-def extract_fields_from_ocr(text):
-    logger.info("Extracting fields from OCR text.")
+async def extract_fields_from_ocr(text, fields: list = None):
+    """用 DeepSeek 从 OCR 文本提取字段；fields 为需要提取的字段子集，默认全部"""
+    fields = fields or ALL_FIELDS
+    logger.info(f"Extracting {len(fields)} field(s) from OCR text.")
+    text = compact_ocr_text(text)
+    field_lines = "\n    ".join(_FIELD_PROMPTS[field] for field in fields)
+    example = json.dumps({field: _FIELD_EXAMPLE[field] for field in fields}, indent=2).replace("\n", "\n    ")
     prompt = f"""This is the raw text extracted from an invoice using OCR. 
     Please extract the following fields and output them as a JSON object, with strict type and format requirements:
 
-    - invoice_number: string
-    - invoice_date: string, must be in "YYYY-MM-DD" format (ISO 8601), e.g. "2025-06-23"
-    - buyer (purchaser): string
-    - seller (vendor): string
-    - invoice_total: number (do not include any currency symbols, commas, or quotes, just the numeric value, e.g. 1234.56)
-    - currency: string (e.g. "USD", "CNY")
-    - category: string
-    - address: string
+    {field_lines}
 
     Return only the JSON object, no extra explanation.
 
     Example output:
-    {{
-      "invoice_number": "INV-20250623-001",
-      "invoice_date": "2025-06-23",
-      "buyer": "Acme Corp",
-      "seller": "Widget Inc",
-      "invoice_total": 1234.56,
-      "currency": "USD",
-      "category": "Office Supplies",
-      "address": "123 Main St, Springfield"
-    }}
+    {example}
 
     Invoice text is as follows:
     {text}
     """
     data = {
-        "model": "deepseek-chat",  
+        "model": DEEPSEEK_MODEL,
         "messages": [
             {"role": "system", "content": "You are an AI assistant specialized in extracting structured data."},
             {"role": "user", "content": prompt}
@@ -453,24 +439,29 @@ def extract_fields_from_ocr(text):
         "stream": False
     }
     try:
-        response = requests.post(DEEPSEEK_URL, headers=DEEP_HEADERS, json=data)
-        response.raise_for_status()
-        response_data = response.json()
-        
-        # 记录 token 使用量
-        if "usage" in response_data:
-            usage = response_data["usage"]
-            logger.info(f"Deepseek field extraction token usage - Prompt: {usage.get('prompt_tokens', 'N/A')}, "
-                       f"Completion: {usage.get('completion_tokens', 'N/A')}, "
-                       f"Total: {usage.get('total_tokens', 'N/A')}")
-            print(f"Total: {usage.get('total_tokens', 'N/A')}")
-        else:
-            logger.warning("No usage information found in Deepseek response")
-        
-        logger.info(f"Deepseek API response: {response.status_code}")
-        return response_data["choices"][0]["message"]["content"]
+        return await deepseek_chat(data)
     except Exception as e:
         logger.exception(f"Field extraction from OCR failed: {str(e)}")
         raise
 
 
+async def extract_fields(text, user_id: str = None) -> tuple:
+    """先用本地规则和卖家模板填充能确定的字段，只让 LLM 提取剩余字段；全部确定时不调用 LLM
+
+    返回 (字段 JSON 字符串, 是否套用了该用户的卖家模板)。
+    """
+    known, defaults, personalized = await rule_extract(text, user_id)
+    missing = [field for field in ALL_FIELDS if field not in known]
+    if not known and not defaults:
+        return await extract_fields_from_ocr(text), False
+    if not missing:
+        metrics.incr("rule_llm_skipped")
+        logger.info("All fields extracted by local rules, skipping LLM")
+        return json.dumps(known, ensure_ascii=False), personalized
+
+    metrics.incr("rule_llm_partial")
+    logger.info(f"Local rules extracted {sorted(known)}, asking LLM for {missing}")
+    extracted = clean_and_parse_json(await extract_fields_from_ocr(text, missing))
+    # 未经标签确认的模板值只在 LLM 没有给出结果时使用
+    filled = {field: extracted.get(field) if extracted.get(field) is not None else defaults.get(field) for field in missing}
+    return json.dumps({**filled, **known}, ensure_ascii=False), personalized
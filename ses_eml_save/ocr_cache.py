@@ -0,0 +1,163 @@
+import os
+import time
+import sqlite3
+import hashlib
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+from dotenv import load_dotenv
+from ses_eml_save.async_clients import table_select, table_upsert
+from ses_eml_save.encryption import encrypt_data, decrypt_data
+from ses_eml_save.llm_client import (MODEL, MODEL_FREE, DEEPSEEK_MODEL, PROMPT_VERSION,
+                                     OCR_PIPELINE_MODE, OCR_COMBINED_INCLUDE_TEXT)
+from ses_eml_save.pdf_text import PDF_TEXT_LAYER_ENABLED, PDF_OCR_ENGINE
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# OCR / 字段提取结果缓存：按内容哈希 + 模型/提示词版本索引，命中时跳过两次 LLM 调用
+OCR_CACHE_ENABLED = (os.getenv("OCR_CACHE_ENABLED") or "true").lower() == "true"
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH") or "cache/ocr_cache.sqlite3"
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES") or 500 * 1024 * 1024)
+OCR_CACHE_SHARED = (os.getenv("OCR_CACHE_SHARED") or "false").lower() == "true"
+OCR_CACHE_TABLE = "ocr_cache_en"
+
+# 模型、提示词或影响缓存内容的流水线配置变化时命名空间随之变化，旧结果自然失效
+CACHE_NAMESPACE = hashlib.sha256("|".join(str(part) for part in (
+    PROMPT_VERSION, MODEL_FREE, MODEL, DEEPSEEK_MODEL,
+    OCR_PIPELINE_MODE, OCR_COMBINED_INCLUDE_TEXT, PDF_TEXT_LAYER_ENABLED, PDF_OCR_ENGINE,
+)).encode()).hexdigest()[:16]
+
+_EVICT_EVERY = 100
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+_puts_since_evict = 0
+
+
+def cache_key(sha256: str) -> str:
+    return f"{CACHE_NAMESPACE}:{sha256}"
+
+
+def _connection() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        directory = os.path.dirname(OCR_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _conn = sqlite3.connect(OCR_CACHE_PATH, check_same_thread=False, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_cache ("
+            "cache_key TEXT PRIMARY KEY, ocr TEXT, fields TEXT, size INTEGER, accessed REAL)"
+        )
+        _conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_accessed ON ocr_cache (accessed)")
+        logger.info(f"Opened OCR cache at {OCR_CACHE_PATH}")
+    return _conn
+
+
+def _evict(conn: sqlite3.Connection):
+    """超过容量上限时按最近访问时间淘汰，直到降到上限的 90%"""
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+    if total <= OCR_CACHE_MAX_BYTES:
+        return
+    target = OCR_CACHE_MAX_BYTES * 0.9
+    evicted = 0
+    for key, size in conn.execute("SELECT cache_key, size FROM ocr_cache ORDER BY accessed").fetchall():
+        if total <= target:
+            break
+        conn.execute("DELETE FROM ocr_cache WHERE cache_key = ?", (key,))
+        total -= size
+        evicted += 1
+    metrics.incr("ocr_cache_evictions", evicted)
+    logger.info(f"Evicted {evicted} OCR cache entries, size now {total} bytes")
+
+
+def _local_get(key: str) -> Optional[dict]:
+    with _lock:
+        conn = _connection()
+        row = conn.execute("SELECT ocr, fields FROM ocr_cache WHERE cache_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE ocr_cache SET accessed = ? WHERE cache_key = ?", (time.time(), key))
+    return decrypt_data(OCR_CACHE_TABLE, {"ocr": row[0], "fields": row[1]})
+
+
+def _local_put(key: str, ocr: str, fields: str):
+    global _puts_since_evict
+    row = encrypt_data(OCR_CACHE_TABLE, {"ocr": ocr, "fields": fields})
+    size = len(row["ocr"] or "") + len(row["fields"] or "")
+    with _lock:
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO ocr_cache (cache_key, ocr, fields, size, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, row["ocr"], row["fields"], size, time.time()),
+        )
+        _puts_since_evict += 1
+        if _puts_since_evict >= _EVICT_EVERY:
+            _puts_since_evict = 0
+            _evict(conn)
+
+
+async def get_cached_ocr(sha256: str, metric: str = "ocr_cache") -> Optional[dict]:
+    """查询 OCR / 字段提取缓存，命中返回 {"ocr", "fields"}；先查本地，再查共享表
+
+    metric 为命中/未命中计数器的前缀，用于区分整文件缓存和 PDF 分块缓存。
+    """
+    if not OCR_CACHE_ENABLED or not sha256:
+        return None
+    key = cache_key(sha256)
+    try:
+        cached = await asyncio.to_thread(_local_get, key)
+        if cached:
+            metrics.incr(f"{metric}_hits")
+            logger.info(f"OCR cache hit for {sha256}")
+            return cached
+
+        if OCR_CACHE_SHARED:
+            rows = await table_select(OCR_CACHE_TABLE, {"cache_key": key}, columns="ocr,fields", limit=1)
+            if rows:
+                cached = decrypt_data(OCR_CACHE_TABLE, rows[0])
+                metrics.incr(f"{metric}_hits")
+                metrics.incr(f"{metric}_shared_hits")
+                logger.info(f"Shared OCR cache hit for {sha256}")
+                await asyncio.to_thread(_local_put, key, cached["ocr"], cached["fields"])
+                return cached
+    except Exception as e:
+        logger.warning(f"OCR cache lookup failed for {sha256}: {str(e)}")
+        return None
+
+    metrics.incr(f"{metric}_misses")
+    return None
+
+
+async def put_cached_ocr(sha256: str, ocr: str, fields: str):
+    """写入 OCR / 字段提取结果，失败时只记录警告"""
+    if not OCR_CACHE_ENABLED or not sha256:
+        return
+    key = cache_key(sha256)
+    try:
+        await asyncio.to_thread(_local_put, key, ocr, fields)
+        if OCR_CACHE_SHARED:
+            row = encrypt_data(OCR_CACHE_TABLE, {
+                "cache_key": key,
+                "ocr": ocr,
+                "fields": fields,
+                "create_time": datetime.utcnow().isoformat(),
+            })
+            await table_upsert(OCR_CACHE_TABLE, row, on_conflict="cache_key")
+    except Exception as e:
+        logger.warning(f"Failed to cache OCR result for {sha256}: {str(e)}")
+
+
+def hit_ratio() -> Optional[float]:
+    counters = metrics.snapshot()
+    hits = counters.get("ocr_cache_hits", 0)
+    total = hits + counters.get("ocr_cache_misses", 0)
+    return round(hits / total, 4) if total else None
@@ -0,0 +1,66 @@
+import io
+import os
+import re
+import logging
+from typing import List
+from dotenv import load_dotenv
+from pypdf import PdfReader, PdfWriter
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 优先使用 PDF 自带的文本层，只对扫描页调用 OCR 模型
+PDF_TEXT_LAYER_ENABLED = (os.getenv("PDF_TEXT_LAYER_ENABLED") or "true").lower() == "true"
+# 每页去除空白后的字符数低于该值时视为扫描页/纯图片页，需要交给 OCR 模型
+PDF_MIN_PAGE_CHARS = int(os.getenv("PDF_MIN_PAGE_CHARS") or 50)
+# 需要 OCR 的页按该页数分块并发请求
+PDF_OCR_CHUNK_PAGES = int(os.getenv("PDF_OCR_CHUNK_PAGES") or 4)
+PDF_OCR_CHUNK_RETRIES = int(os.getenv("PDF_OCR_CHUNK_RETRIES") or 1)
+# 发给模型的 PDF 只剩扫描页，OpenRouter file-parser 须用能识别图片的引擎：mistral-ocr，或模型支持文件输入时用 native
+PDF_OCR_ENGINE = os.getenv("PDF_OCR_ENGINE") or "mistral-ocr"
+
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+
+
+def _page_text(page) -> str:
+    try:
+        text = page.extract_text(extraction_mode="layout")
+    except Exception:
+        # 个别字体/内容流在 layout 模式下解析失败，退回普通模式
+        text = page.extract_text()
+    lines = [line.rstrip() for line in (text or "").splitlines()]
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def count_pdf_pages(data: bytes) -> int:
+    reader = PdfReader(io.BytesIO(data))
+    if reader.is_encrypted:
+        reader.decrypt("")
+    return len(reader.pages)
+
+
+def extract_pdf_pages(data: bytes) -> List[str]:
+    """按阅读顺序提取每页文本层（保留版式），在 CPU 进程池中执行"""
+    reader = PdfReader(io.BytesIO(data))
+    if reader.is_encrypted:
+        reader.decrypt("")
+    return [_page_text(page) for page in reader.pages]
+
+
+def is_scanned_page(text: str) -> bool:
+    return len("".join(text.split())) < PDF_MIN_PAGE_CHARS
+
+
+def select_pdf_pages(data: bytes, page_indexes: List[int]) -> bytes:
+    """生成只包含指定页（从 0 开始）的新 PDF，在 CPU 进程池中执行"""
+    reader = PdfReader(io.BytesIO(data))
+    if reader.is_encrypted:
+        reader.decrypt("")
+    writer = PdfWriter()
+    for index in page_indexes:
+        writer.add_page(reader.pages[index])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
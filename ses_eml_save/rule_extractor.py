@@ -0,0 +1,364 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+from datetime import date, datetime
+from typing import Optional
+from dotenv import load_dotenv
+from ses_eml_save.async_clients import table_select, table_upsert
+from ses_eml_save.encryption import encrypt_data, decrypt_data
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 本地规则提取：先用正则和按卖家学到的模板填充能确定的字段，只把剩余字段交给 LLM
+RULE_EXTRACTION_ENABLED = (os.getenv("RULE_EXTRACTION_ENABLED") or "true").lower() == "true"
+RULE_TEMPLATES_ENABLED = (os.getenv("RULE_TEMPLATES_ENABLED") or "true").lower() == "true"
+RULE_TEMPLATE_CACHE_TTL = float(os.getenv("RULE_TEMPLATE_CACHE_TTL") or 300)
+SELLER_TEMPLATE_TABLE = "seller_templates_en"
+
+ALL_FIELDS = ["invoice_number", "invoice_date", "buyer", "seller", "invoice_total", "currency", "category", "address"]
+# 同一卖家的这些字段通常不变，直接取用户确认过的值
+_STATIC_FIELDS = ["seller", "buyer", "address", "category", "currency"]
+_ANCHOR_FIELDS = ["invoice_number", "invoice_date", "invoice_total"]
+_TEMPLATE_LIMIT = 500
+# 卖家名称只在文档开头几行或带卖家标签的行里匹配，正文里顺带提到的公司名（如 "Paid with Apple Pay"）不算
+_TEMPLATE_HEADER_LINES = 8
+_MAX_LABEL_CHARS = 40
+
+_MONTHS = {
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+_MONTH = r"(jan|feb|mar|apr|may|jun|jul|aug|sept?|oct|nov|dec)[a-z]*\.?"
+_DATE_PATTERNS = [
+    ("ymd", re.compile(r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})")),
+    ("dmy_or_mdy", re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b")),
+    ("mdy", re.compile(_MONTH + r"\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(\d{4})", re.IGNORECASE)),
+    ("dmy", re.compile(r"\b(\d{1,2})(?:st|nd|rd|th)?\s+" + _MONTH + r",?\s+(\d{4})", re.IGNORECASE)),
+]
+_AMOUNT = re.compile(r"(?<![\d.,])(\d{1,3}(?:[,.]\d{3})+(?:[.,]\d{1,2})?|\d+(?:[.,]\d{1,2})?)(?![\d.,]*\d)")
+_NUMBER_LABEL = re.compile(
+    r"(?:invoice|receipt|bill|order)\s*(?:number|num\b|no\b\.?|#|id\b)|发票号码|发票号|订单号|单号",
+    re.IGNORECASE,
+)
+_NUMBER_VALUE = re.compile(r"[A-Z0-9][A-Z0-9\-/_.]*\d[A-Z0-9\-/_.]*", re.IGNORECASE)
+_DATE_LABEL = re.compile(
+    r"invoice date|date of issue|issue date|issued on|date issued|date paid|billing date|receipt date|开票日期|日期",
+    re.IGNORECASE,
+)
+# 应付/实付总额优先于普通 total；小计、税额、不含税金额不作为总额
+_TOTAL_LABELS = [
+    re.compile(r"amount due|balance due|total due|grand total|amount paid|total paid|amount charged|"
+               r"价税合计|应付金额|实付金额|实付款", re.IGNORECASE),
+    re.compile(r"\btotal\b|合计|总计", re.IGNORECASE),
+]
+_TOTAL_EXCLUDE = re.compile(
+    r"sub\s*-?total|excl|before tax|(?:total|amount)\s+(?:tax|vat|gst)|(?:tax|vat|gst)\s+(?:total|amount)|小计|税额|不含税",
+    re.IGNORECASE,
+)
+_CURRENCY_CODES = re.compile(r"\b(USD|EUR|GBP|CNY|RMB|JPY|CAD|AUD|HKD|SGD|CHF|INR|TWD|KRW|NZD)\b")
+# 只收录能唯一确定币种的符号；单独的 $、¥ 可能是多种货币，交给 LLM 结合上下文判断
+_CURRENCY_SYMBOLS = [
+    ("US$", "USD"), ("CA$", "CAD"), ("C$", "CAD"), ("AU$", "AUD"), ("A$", "AUD"), ("HK$", "HKD"),
+    ("SG$", "SGD"), ("S$", "SGD"), ("NT$", "TWD"), ("NZ$", "NZD"),
+    ("€", "EUR"), ("£", "GBP"), ("元", "CNY"), ("₩", "KRW"), ("₹", "INR"),
+]
+_SPACES = re.compile(r"\s+")
+_SELLER_LABEL = re.compile(
+    r"seller|vendor|merchant|supplier|sold by|issued by|billed by|from\b|销售方|销方|收款方|商户|开票方",
+    re.IGNORECASE,
+)
+_PAYMENT_LINE = re.compile(r"paid (?:with|by|via|using)|pay(?:ment)? (?:with|via|method)|支付方式|付款方式", re.IGNORECASE)
+
+# 用户的卖家模板缓存：user_id -> (过期时间, 模板列表)
+_template_cache = {}
+
+
+def _valid_date(year: int, month: int, day: int) -> Optional[str]:
+    try:
+        return date(year, month, day).isoformat()
+    except ValueError:
+        return None
+
+
+def parse_date(text: str) -> Optional[str]:
+    """从文本中解析第一个能确定的日期并转为 YYYY-MM-DD；日/月无法区分时返回 None"""
+    for kind, pattern in _DATE_PATTERNS:
+        match = pattern.search(text)
+        if not match:
+            continue
+        groups = match.groups()
+        if kind == "ymd":
+            return _valid_date(int(groups[0]), int(groups[1]), int(groups[2]))
+        if kind == "mdy":
+            return _valid_date(int(groups[2]), _MONTHS[groups[0][:3].lower()], int(groups[1]))
+        if kind == "dmy":
+            return _valid_date(int(groups[2]), _MONTHS[groups[1][:3].lower()], int(groups[0]))
+        first, second, year = int(groups[0]), int(groups[1]), int(groups[2])
+        if first > 12 >= second:
+            return _valid_date(year, second, first)
+        if second > 12 >= first:
+            return _valid_date(year, first, second)
+        if first == second:
+            return _valid_date(year, first, second)
+        return None
+    return None
+
+
+def parse_amount(text: str) -> Optional[float]:
+    """解析文本中的最后一个金额，兼容 1,234.56 / 1.234,56 写法
+
+    只有一个分隔符且后面正好三位数字（如 1.234、150.000）时无法区分千分位和小数点，返回 None。
+    """
+    matches = _AMOUNT.findall(text)
+    if not matches:
+        return None
+    raw = matches[-1]
+    separators = [char for char in raw if char in ",."]
+    if len(separators) == 1 and len(raw) - raw.index(separators[0]) - 1 == 3:
+        return None
+    if "," in raw and "." in raw:
+        decimal = "," if raw.rfind(",") > raw.rfind(".") else "."
+        raw = raw.replace("." if decimal == "," else ",", "").replace(",", ".")
+    elif "," in raw:
+        head, _, tail = raw.rpartition(",")
+        raw = f"{head.replace(',', '')}.{tail}" if len(tail) <= 2 else raw.replace(",", "")
+    try:
+        return round(float(raw), 2)
+    except ValueError:
+        return None
+
+
+def parse_currency(text: str) -> Optional[str]:
+    codes = {("CNY" if code == "RMB" else code) for code in _CURRENCY_CODES.findall(text)}
+    if len(codes) == 1:
+        return codes.pop()
+    if codes:
+        return None
+    # 多个不同符号同时出现时同样视为不确定
+    found = set()
+    for symbol, code in _CURRENCY_SYMBOLS:
+        if symbol in text:
+            found.add(code)
+            text = text.replace(symbol, "")
+    return found.pop() if len(found) == 1 else None
+
+
+def _parse_invoice_number(text: str) -> Optional[str]:
+    match = _NUMBER_VALUE.search(text)
+    return match.group(0).rstrip("./") if match else None
+
+
+def _unique(values: list):
+    distinct = list(dict.fromkeys(value for value in values if value is not None))
+    return distinct[0] if len(distinct) == 1 else None
+
+
+def _lines(text: str) -> list:
+    return [line for line in (_SPACES.sub(" ", raw).strip() for raw in text.splitlines()) if line]
+
+
+def _value_after(lines: list, index: int, end: int) -> str:
+    """标签后面的值：同一行剩余部分，为空时取下一行"""
+    rest = lines[index][end:].strip(" :：#|\t")
+    if rest or index + 1 >= len(lines):
+        return rest
+    return lines[index + 1]
+
+
+def _generic_fields(lines: list) -> dict:
+    """通用正则规则；同一字段出现多个不同候选值时视为不确定，不填"""
+    fields = {}
+
+    numbers = []
+    dates = []
+    for index, line in enumerate(lines):
+        match = _NUMBER_LABEL.search(line)
+        if match:
+            numbers.append(_parse_invoice_number(_value_after(lines, index, match.end())))
+        match = _DATE_LABEL.search(line)
+        if match:
+            dates.append(parse_date(_value_after(lines, index, match.end())))
+    fields["invoice_number"] = _unique(numbers)
+    fields["invoice_date"] = _unique(dates)
+
+    total_line = None
+    for label in _TOTAL_LABELS:
+        candidates = []
+        for index, line in enumerate(lines):
+            match = label.search(line)
+            if match and not _TOTAL_EXCLUDE.search(line):
+                value = _value_after(lines, index, match.end())
+                amount = parse_amount(value)
+                if amount is not None:
+                    candidates.append(amount)
+                    total_line = total_line or f"{line} {value}"
+        if candidates:
+            fields["invoice_total"] = _unique(candidates)
+            break
+
+    # 币种优先看总额所在行，其次看全文
+    fields["currency"] = (parse_currency(total_line) if total_line else None) or parse_currency("\n".join(lines))
+    return {field: value for field, value in fields.items() if value is not None}
+
+
+def _anchor_value(lines: list, label: str, field: str):
+    """按模板标签取值；标签前不能紧跟字母数字，避免 Total 命中 Subtotal"""
+    pattern = re.compile(r"(?<!\w)" + re.escape(label), re.IGNORECASE)
+    parse = {"invoice_total": parse_amount, "invoice_date": parse_date}.get(field, _parse_invoice_number)
+    for index, line in enumerate(lines):
+        match = pattern.search(line)
+        if match:
+            value = parse(_value_after(lines, index, match.end()))
+            if value is not None:
+                return value
+    return None
+
+
+def _seller_key(seller: str) -> str:
+    return hashlib.sha256(_SPACES.sub(" ", seller).strip().lower().encode("utf-8")).hexdigest()
+
+
+async def _user_templates(user_id: str) -> list:
+    cached = _template_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    try:
+        rows = await table_select(SELLER_TEMPLATE_TABLE, {"user_id": user_id}, columns="template", limit=_TEMPLATE_LIMIT)
+        templates = [json.loads(decrypt_data(SELLER_TEMPLATE_TABLE, row)["template"]) for row in rows]
+    except Exception as e:
+        logger.warning(f"Failed to load seller templates for user {user_id}: {str(e)}")
+        templates = []
+    _template_cache[user_id] = (time.monotonic() + RULE_TEMPLATE_CACHE_TTL, templates)
+    return templates
+
+
+def _seller_lines(lines: list) -> list:
+    """可能写有卖家名称的行：文档开头几行和带卖家标签的行，付款方式行除外"""
+    return [
+        line.lower() for index, line in enumerate(lines)
+        if (index < _TEMPLATE_HEADER_LINES or _SELLER_LABEL.search(line)) and not _PAYMENT_LINE.search(line)
+    ]
+
+
+def _mentions_seller(seller_lines: list, seller: str) -> bool:
+    pattern = re.compile(r"(?<!\w)" + re.escape(seller) + r"(?!\w)")
+    return any(pattern.search(line) for line in seller_lines)
+
+
+def _match_template(templates: list, lines: list) -> Optional[dict]:
+    """卖家名称按整词出现在卖家行中才匹配模板，多个命中时取名称最长的"""
+    seller_lines = _seller_lines(lines)
+    matched = [template for template in templates if template.get("match") and _mentions_seller(seller_lines, template["match"])]
+    return max(matched, key=lambda template: len(template["match"])) if matched else None
+
+
+async def rule_extract(text: str, user_id: str = None) -> tuple:
+    """返回 (本地规则能确定的字段, 模板提供的默认值, 是否套用了该用户的卖家模板)
+
+    模板的标签字段全部在文档中取到值时，才认为版式与该卖家一致，把模板中的卖家信息并入确定字段；
+    否则卖家信息只作为默认值，仍由 LLM 提取，LLM 没有给出时才使用。
+    字段值为 None 表示模板确认过该字段为空。套用模板的结果带有用户自己的修改，不能跨用户共享。
+    """
+    if not RULE_EXTRACTION_ENABLED or not text:
+        return {}, {}, False
+    lines = _lines(text)
+    fields = _generic_fields(lines)
+    defaults = {}
+
+    template = None
+    if RULE_TEMPLATES_ENABLED and user_id:
+        template = _match_template(await _user_templates(user_id), lines)
+    if template:
+        metrics.incr("rule_template_hits")
+        logger.info(f"Matched seller template for {template['static'].get('seller')}")
+        anchors = template.get("anchors", {})
+        anchored = {field: _anchor_value(lines, label, field) for field, label in anchors.items()}
+        fields.update({field: value for field, value in anchored.items() if value is not None})
+        static = template.get("static", {})
+        if set(anchors) == set(_ANCHOR_FIELDS) and None not in anchored.values():
+            # 文档中取到的值优先，模板只补充文档里没有的卖家信息
+            for field, value in static.items():
+                fields.setdefault(field, value)
+        else:
+            metrics.incr("rule_template_unconfirmed")
+            defaults = {field: value for field, value in static.items() if field not in fields and value is not None}
+
+    metrics.incr("rule_fields_filled", len(fields))
+    return fields, defaults, template is not None
+
+
+def _find_anchor(lines: list, field: str, value) -> Optional[str]:
+    """在用户确认过的 OCR 文本里找到该字段值所在行，返回值前面的标签文字"""
+    for index, line in enumerate(lines):
+        if field == "invoice_number":
+            position = line.find(str(value))
+        else:
+            candidates = _AMOUNT.finditer(line) if field == "invoice_total" else (
+                match for _, pattern in _DATE_PATTERNS for match in pattern.finditer(line))
+            parse = parse_amount if field == "invoice_total" else parse_date
+            position = next((match.start() for match in candidates if parse(match.group(0)) == value), -1)
+        if position < 0:
+            continue
+        label = line[:position].strip(" :：#|\t$€£¥￥")
+        if not label and index > 0:
+            label = lines[index - 1]
+        label = label[-_MAX_LABEL_CHARS:].strip()
+        if re.search(r"[^\W\d_]", label):
+            return label
+    return None
+
+
+def build_template(ocr: str, record: dict) -> Optional[dict]:
+    """由用户确认过的收据（OCR 文本 + 字段）生成卖家模板；卖家名称不在卖家行里时无法匹配，返回 None"""
+    seller = _SPACES.sub(" ", record.get("seller") or "").strip()
+    if not seller or not ocr:
+        return None
+    lines = _lines(ocr)
+    if not _mentions_seller(_seller_lines(lines), seller.lower()):
+        return None
+    anchors = {}
+    for field in _ANCHOR_FIELDS:
+        value = record.get(field)
+        if value in (None, ""):
+            continue
+        if field == "invoice_total":
+            value = round(float(value), 2)
+        elif field == "invoice_date":
+            value = str(value)[:10]
+        label = _find_anchor(lines, field, value)
+        if label:
+            anchors[field] = label
+    return {
+        "match": seller.lower(),
+        "static": {field: record.get(field) or None for field in _STATIC_FIELDS},
+        "anchors": anchors,
+    }
+
+
+async def learn_template(user_id: str, record: dict):
+    """用户修改/确认收据后，更新该用户对应卖家的模板；失败时只记录警告"""
+    if not RULE_TEMPLATES_ENABLED:
+        return
+    try:
+        template = build_template(record.get("ocr") or "", record)
+        if template is None:
+            return
+        row = encrypt_data(SELLER_TEMPLATE_TABLE, {
+            "user_id": user_id,
+            "seller_key": _seller_key(template["match"]),
+            "template": json.dumps(template, ensure_ascii=False),
+            "update_time": datetime.utcnow().isoformat(),
+        })
+        await table_upsert(SELLER_TEMPLATE_TABLE, row, on_conflict="user_id,seller_key")
+        _template_cache.pop(user_id, None)
+        metrics.incr("rule_templates_learned")
+        logger.info(f"Learned seller template for {template['static']['seller']} with anchors {list(template['anchors'])}")
+    except Exception as e:
+        logger.warning(f"Failed to learn seller template for user {user_id}: {str(e)}")
@@ -1,10 +1,14 @@
+import io
 import os
 import uuid
+import asyncio
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from playwright.async_api import async_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from ses_eml_save.browser_pool import browser_page
+from PIL import Image
+from ses_eml_save import metrics
 
 
 
@@ -13,69 +17,96 @@ load_dotenv()
 # 设置日志
 logger = logging.getLogger(__name__)
 
-# Supabase config
-SUPABASE_URL = os.getenv("SUPABASE_URL") or ""
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
-SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
+# 正文截图配置：固定宽度、最大高度、输出格式（png/jpeg/webp）与质量，可选按高度切块
+RENDER_VIEWPORT_WIDTH = int(os.getenv("RENDER_VIEWPORT_WIDTH") or 800)
+RENDER_VIEWPORT_HEIGHT = int(os.getenv("RENDER_VIEWPORT_HEIGHT") or 1024)
+RENDER_MAX_HEIGHT = int(os.getenv("RENDER_MAX_HEIGHT") or 6000)
+RENDER_TILE_HEIGHT = int(os.getenv("RENDER_TILE_HEIGHT") or 0)
+RENDER_IMAGE_FORMAT = (os.getenv("RENDER_IMAGE_FORMAT") or "jpeg").lower()
+RENDER_IMAGE_QUALITY = int(os.getenv("RENDER_IMAGE_QUALITY") or 70)
+RENDER_CONTENT_TIMEOUT = float(os.getenv("RENDER_CONTENT_TIMEOUT") or 10)
+RENDER_NETWORK_IDLE_TIMEOUT = float(os.getenv("RENDER_NETWORK_IDLE_TIMEOUT") or 3)
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+_CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
 
+if RENDER_IMAGE_FORMAT not in _CONTENT_TYPES:
+    raise ValueError(f"Unsupported RENDER_IMAGE_FORMAT: {RENDER_IMAGE_FORMAT}")
 
 
-async def render_html_string_to_image_and_upload(html_string: str, user_id:str, filename: str) -> dict:
+
+def _to_webp(png_bytes: bytes) -> bytes:
+    with Image.open(io.BytesIO(png_bytes)) as image:
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="WEBP", quality=RENDER_IMAGE_QUALITY, method=4)
+        return output.getvalue()
+
+
+async def _capture(page, y: int, height: int) -> bytes:
+    """截取页面中 [y, y+height) 区域，按配置的格式和质量编码"""
+    clip = {"x": 0, "y": y, "width": RENDER_VIEWPORT_WIDTH, "height": height}
+    if RENDER_IMAGE_FORMAT == "jpeg":
+        return await page.screenshot(clip=clip, full_page=True, type="jpeg", quality=RENDER_IMAGE_QUALITY)
+    png_bytes = await page.screenshot(clip=clip, full_page=True, type="png")
+    if RENDER_IMAGE_FORMAT == "webp":
+        return await asyncio.to_thread(_to_webp, png_bytes)
+    return png_bytes
+
+
+async def render_html_string_to_image(html_string: str, user_id:str, filename: str) -> dict:
+    """把 HTML 正文渲染成图片，返回待处理文件（含内存中的图片字节和预先生成的存储路径）
+
+    截图宽度固定为 RENDER_VIEWPORT_WIDTH，高度截断到 RENDER_MAX_HEIGHT；
+    开启 RENDER_TILE_HEIGHT 时，超高页面额外切成若干图块（file["tiles"]）供视觉模型逐块识别。
+    """
     logger.info(f"Starting HTML to image conversion for filename: {filename}")
     
     # 生成唯一文件名
-    image_file = f"eml_body_{datetime.utcnow().timestamp()}_{str(uuid.uuid4())[:8]}.png"
-    logger.info(f"Generated temporary image filename: {image_file}")
+    image_file = f"eml_body_{datetime.utcnow().timestamp()}_{str(uuid.uuid4())[:8]}{_EXTENSIONS[RENDER_IMAGE_FORMAT]}"
+    logger.info(f"Generated image filename: {image_file}")
 
     try:
-        # 用 Playwright 渲染 HTML 字符串
-        logger.info("Launching Playwright browser for HTML rendering")
-        async with async_playwright() as p:
-            browser = await p.chromium.launch()
-            page = await browser.new_page()
+        # 用常驻浏览器池中的页面渲染 HTML 字符串，池满时排队等待
+        async with browser_page() as page:
+            await page.set_viewport_size({"width": RENDER_VIEWPORT_WIDTH, "height": RENDER_VIEWPORT_HEIGHT})
             logger.info("Setting HTML content in browser page")
-            await page.set_content(html_string)
-            logger.info("Taking screenshot of HTML content")
-            await page.screenshot(path=image_file, full_page=True)
-            await browser.close()
-        
-        logger.info(f"Screenshot saved to local file: {image_file}")
+            await page.set_content(html_string, wait_until="domcontentloaded", timeout=RENDER_CONTENT_TIMEOUT * 1000)
+            # 外部图片/CSS 最多再等 RENDER_NETWORK_IDLE_TIMEOUT 秒，慢主机或死链不会拖住截图
+            try:
+                await page.wait_for_load_state("networkidle", timeout=RENDER_NETWORK_IDLE_TIMEOUT * 1000)
+            except PlaywrightTimeoutError:
+                metrics.incr("render_network_idle_timeouts")
+                logger.warning(f"Network not idle after {RENDER_NETWORK_IDLE_TIMEOUT}s, taking screenshot anyway")
 
-        # 上传至 Supabase Storage
-        storage_path = f"users/{user_id}/{datetime.utcnow().date().isoformat()}/{image_file}"
-        logger.info(f"Uploading image to Supabase Storage: {storage_path}")
-        
-        with open(image_file, "rb") as f:
-            supabase.storage.from_(SUPABASE_BUCKET).upload(storage_path, f, {
-                "content-type": "image/png"
-            })
-        
-        logger.info("Image uploaded successfully to Supabase Storage")
+            content_height = int(await page.evaluate("Math.max(document.body ? document.body.scrollHeight : 0, document.documentElement.scrollHeight)") or 0)
+            height = max(1, min(content_height, RENDER_MAX_HEIGHT))
+            if content_height > RENDER_MAX_HEIGHT:
+                logger.warning(f"Page height {content_height}px exceeds RENDER_MAX_HEIGHT, truncated to {RENDER_MAX_HEIGHT}px")
 
-        # 获取公开 URL
-        #public_url = supabase.storage.from_(SUPABASE_BUCKET).get_public_url(storage_path).rstrip('?')
-        #logger.info(f"Generated public URL: {public_url}")
-        signed_url_result = supabase.storage.from_(SUPABASE_BUCKET).create_signed_url(storage_path, expires_in=86400)
-        public_url = signed_url_result["signedURL"]
+            logger.info(f"Taking {RENDER_IMAGE_FORMAT} screenshot of HTML content, {RENDER_VIEWPORT_WIDTH}x{height}px")
+            image_bytes = await _capture(page, 0, height)
 
-        # 清理本地临时文件
-        os.remove(image_file)
-        logger.info(f"Local temporary file removed: {image_file}")
-        
-        public_urls = {}
-        public_urls[filename] = [public_url,storage_path]
+            tiles = []
+            if RENDER_TILE_HEIGHT and height > RENDER_TILE_HEIGHT:
+                for y in range(0, height, RENDER_TILE_HEIGHT):
+                    tiles.append(await _capture(page, y, min(RENDER_TILE_HEIGHT, height - y)))
+                logger.info(f"Split page into {len(tiles)} tiles of up to {RENDER_TILE_HEIGHT}px")
+
+        metrics.incr("render_image_bytes", len(image_bytes))
+        logger.info(f"Screenshot captured in memory, size: {len(image_bytes)} bytes")
+
+        storage_path = f"users/{user_id}/{datetime.utcnow().date().isoformat()}/{image_file}"
         logger.info(f"HTML to image conversion completed successfully for: {filename}")
-        return public_urls
+        file = {
+            "filename": filename,
+            "content_type": _CONTENT_TYPES[RENDER_IMAGE_FORMAT],
+            "binary": image_bytes,
+            "storage_path": storage_path,
+        }
+        if tiles:
+            file["tiles"] = tiles
+        return file
         
     except Exception as e:
         logger.exception(f"Failed to convert HTML to image for {filename}: {str(e)}")
-        # 确保清理临时文件
-        if os.path.exists(image_file):
-            try:
-                os.remove(image_file)
-                logger.info(f"Cleaned up temporary file after error: {image_file}")
-            except Exception as cleanup_error:
-                logger.warning(f"Failed to cleanup temporary file {image_file}: {str(cleanup_error)}")
         raise
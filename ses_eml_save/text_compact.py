@@ -0,0 +1,146 @@
+import os
+import re
+import math
+import hashlib
+import logging
+import threading
+from collections import Counter
+from dotenv import load_dotenv
+from ses_eml_save.util import env_list
+from ses_eml_save import metrics
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+# 字段提取前压缩 OCR 文本：规整空白、去掉重复行和样板文字，超出 token 预算时优先保留金额/日期/发票号附近的行
+OCR_COMPACT_ENABLED = (os.getenv("OCR_COMPACT_ENABLED") or "true").lower() == "true"
+OCR_TOKEN_BUDGET = int(os.getenv("OCR_TOKEN_BUDGET") or 3000)
+# 关键字行前后各保留的行数
+OCR_COMPACT_CONTEXT_LINES = int(os.getenv("OCR_COMPACT_CONTEXT_LINES") or 1)
+# 文档开头的行通常包含买卖双方名称和地址，优先级仅次于关键字行
+OCR_COMPACT_HEAD_LINES = int(os.getenv("OCR_COMPACT_HEAD_LINES") or 10)
+OCR_BOILERPLATE_PHRASES = env_list(
+    "OCR_BOILERPLATE_PHRASES",
+    "terms and conditions,terms of service,privacy policy,all rights reserved,unsubscribe,"
+    "this email was sent,do not reply,view in browser,view this email,manage your preferences,"
+    "版权所有,退订,请勿回复"
+)
+# 不含数字的长行在这么多份不同文档中出现后视为疑似样板文字（条款、免责声明等），超出预算时最先舍弃；0 表示不学习
+OCR_BOILERPLATE_LEARN_MIN_DOCS = int(os.getenv("OCR_BOILERPLATE_LEARN_MIN_DOCS") or 5)
+
+_LEARN_MIN_CHARS = 40
+# 超过该长度的关键字行多半是条款正文，不按字段行优先保留
+_FIELD_LINE_MAX_CHARS = 120
+_LEARN_MAX_LINES = 20000
+
+_SPACES = re.compile(r"[ \t\r\f\v\u00a0\u200b\u3000]+")
+_DIGIT = re.compile(r"\d")
+_LETTER = re.compile(r"[^\W\d_]")
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+_KEYWORDS = re.compile(
+    r"total|amount|balance|due|subtotal|tax|vat|gst|invoice|receipt|bill|date|issued|paid|"
+    r"order|no\.|number|#|seller|vendor|buyer|sold|"
+    r"合计|总计|金额|价税|税额|发票|收据|日期|开票|购买方|销售方|名称|号码|编号",
+    re.IGNORECASE,
+)
+
+# 跨文档学习的样板行：行哈希 -> 出现过的文档数
+_line_documents = Counter()
+_learn_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个 token，其余字符按 4 个字符 1 个 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _line_key(line: str) -> str:
+    return hashlib.sha1(line.lower().encode("utf-8")).hexdigest()
+
+
+def _learnable(line: str) -> bool:
+    return len(line) >= _LEARN_MIN_CHARS and not _DIGIT.search(line) and not _KEYWORDS.search(line)
+
+
+def _learn_boilerplate(lines: list) -> set:
+    """记录本文档中可学习的行，返回已达到阈值的样板行哈希"""
+    if OCR_BOILERPLATE_LEARN_MIN_DOCS <= 0:
+        return set()
+    keys = {_line_key(line) for line in lines if _learnable(line)}
+    with _learn_lock:
+        known = {key for key in keys if _line_documents[key] >= OCR_BOILERPLATE_LEARN_MIN_DOCS}
+        _line_documents.update(keys)
+        if len(_line_documents) > _LEARN_MAX_LINES:
+            # 只保留出现次数最多的一半，避免无限增长
+            kept = _line_documents.most_common(_LEARN_MAX_LINES // 2)
+            _line_documents.clear()
+            _line_documents.update(dict(kept))
+    return known
+
+
+def _is_boilerplate(line: str) -> bool:
+    lowered = line.lower()
+    return any(phrase in lowered for phrase in OCR_BOILERPLATE_PHRASES)
+
+
+def _priority(index: int, line: str, near_keyword: set, learned: set) -> int:
+    """学到的重复行只降低优先级，不直接删除：同一卖家的名称、地址行也会在多份文档中重复"""
+    if index in near_keyword:
+        return 0
+    if index < OCR_COMPACT_HEAD_LINES:
+        return 1
+    if _learnable(line) and _line_key(line) in learned:
+        return 4
+    if _DIGIT.search(line):
+        return 2
+    return 3
+
+
+def compact_ocr_text(text: str) -> str:
+    """压缩发给字段提取模型的 OCR 文本，并记录压缩前后的估算 token 数"""
+    if not OCR_COMPACT_ENABLED or not text:
+        return text
+    tokens_before = estimate_tokens(text)
+
+    lines = []
+    seen = set()
+    for raw_line in text.splitlines():
+        line = _SPACES.sub(" ", raw_line).strip()
+        if not line:
+            continue
+        # 分页重复的页眉页脚、表头只保留第一次出现；纯数字/金额行可能是不同明细，不去重
+        if _LETTER.search(line):
+            if line.lower() in seen:
+                continue
+            seen.add(line.lower())
+        lines.append(line)
+
+    learned = _learn_boilerplate(lines)
+    lines = [line for line in lines if not _is_boilerplate(line)]
+
+    if estimate_tokens("\n".join(lines)) > OCR_TOKEN_BUDGET:
+        near_keyword = set()
+        for index, line in enumerate(lines):
+            if len(line) <= _FIELD_LINE_MAX_CHARS and _KEYWORDS.search(line):
+                near_keyword.update(range(index - OCR_COMPACT_CONTEXT_LINES, index + OCR_COMPACT_CONTEXT_LINES + 1))
+        ranked = sorted(range(len(lines)), key=lambda index: (_priority(index, lines[index], near_keyword, learned), index))
+        kept = set()
+        budget = OCR_TOKEN_BUDGET
+        for index in ranked:
+            cost = estimate_tokens(lines[index]) + 1
+            if cost <= budget:
+                kept.add(index)
+                budget -= cost
+        metrics.incr("ocr_compact_truncated")
+        lines = [line for index, line in enumerate(lines) if index in kept]
+
+    compacted = "\n".join(lines)
+    tokens_after = estimate_tokens(compacted)
+    metrics.incr("ocr_compact_tokens_before", tokens_before)
+    metrics.incr("ocr_compact_tokens_after", tokens_after)
+    logger.info(f"Compacted OCR text from ~{tokens_before} to ~{tokens_after} tokens (budget {OCR_TOKEN_BUDGET})")
+    return compacted
@@ -1,3 +1,4 @@
+import os
 import re
 import json
 import unicodedata
@@ -42,6 +43,27 @@ def make_safe_storage_path(filename: str, prefix: str = "") -> str:
     logger.info(f"Sanitized filename result: {result}")
     return result
 
+def env_list(name: str, default: str) -> list:
+    """读取逗号分隔的环境变量，去除空白并转为小写"""
+    return [item.strip().lower() for item in (os.getenv(name) or default).split(",") if item.strip()]
+
+def read_binary(binary) -> bytes:
+    """读取附件内容：bytes 直接返回，文件对象从头读取"""
+    if hasattr(binary, "read"):
+        binary.seek(0)
+        return binary.read()
+    return binary
+
+def read_head(binary, size: int) -> bytes:
+    """读取附件开头的若干字节，不改变文件对象的读取位置"""
+    if hasattr(binary, "read"):
+        position = binary.tell()
+        binary.seek(0)
+        head = binary.read(size)
+        binary.seek(position)
+        return head
+    return bytes(binary[:size])
+
 def clean_and_parse_json(text: str) -> dict:
     logger.info("Cleaning and parsing JSON text.")
     try:
@@ -0,0 +1,13 @@
+import os
+import sys
+import base64
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 模块导入时读取这些配置，测试中使用本地假值
+os.environ.setdefault("ENCRYPTION_KEY", base64.b64encode(Fernet.generate_key()).decode())
+os.environ.setdefault("SUPABASE_URL", "http://supabase.test")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "test-key")
+os.environ.setdefault("SUPABASE_BUCKET", "test-bucket")
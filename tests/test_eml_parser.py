@@ -0,0 +1,71 @@
+import io
+from email.message import EmailMessage
+
+import pytest
+
+from ses_eml_save.eml_parser import close_attachments, mail_parser_stream
+
+
+PDF = b"%PDF-1.4\n" + bytes(range(256)) * 8
+
+
+def _invoice_message():
+    message = EmailMessage()
+    message["From"] = "billing@vendor.example"
+    message["To"] = "me@example.com"
+    message["Subject"] = "Invoice"
+    message.set_content("Your invoice is attached.")
+    message.add_attachment(PDF, maintype="application", subtype="pdf", filename="inv.pdf")
+    return message
+
+
+def _parse(raw):
+    mail = mail_parser_stream(io.BytesIO(raw))
+    attachments = [(att["filename"], att["content_type"], att["binary"].read()) for att in mail["attachments"]]
+    close_attachments(mail["attachments"])
+    return mail, attachments
+
+
+def test_plain_message_with_pdf():
+    mail, attachments = _parse(_invoice_message().as_bytes())
+    assert mail["from_email"] == "billing@vendor.example"
+    assert mail["subject"] == "Invoice"
+    assert mail["body"].strip() == "Your invoice is attached."
+    assert attachments == [("inv.pdf", "application/pdf", PDF)]
+
+
+def test_forwarded_message_attachment_is_walked():
+    forward = EmailMessage()
+    forward["From"] = "me@example.com"
+    forward["To"] = "receipts@service.example"
+    forward["Subject"] = "Fwd: Invoice"
+    forward.set_content("See the forwarded invoice.")
+    forward.add_attachment(_invoice_message())
+
+    mail, attachments = _parse(forward.as_bytes())
+    # 外层正文不被内层邮件正文覆盖，内层邮件中的 PDF 与 email.walk() 一样被取出
+    assert mail["body"].strip() == "See the forwarded invoice."
+    assert ("inv.pdf", "application/pdf", PDF) in attachments
+    assert not any(content_type == "message/rfc822" for _, content_type, _ in attachments)
+
+
+def test_quoted_printable_body_and_crlf_boundaries():
+    message = EmailMessage()
+    message["From"] = "billing@vendor.example"
+    message.set_content("Total: 100 €\n", cte="quoted-printable")
+    message.add_attachment(PDF, maintype="application", subtype="pdf", filename="inv.pdf")
+    raw = message.as_bytes().replace(b"\n", b"\r\n")
+
+    mail, attachments = _parse(raw)
+    assert mail["body"].strip() == "Total: 100 €"
+    assert attachments == [("inv.pdf", "application/pdf", PDF)]
+
+
+@pytest.mark.parametrize("cte", ["base64", "quoted-printable"])
+def test_encoded_attachment_round_trip(cte):
+    message = EmailMessage()
+    message["From"] = "a@example.com"
+    message.set_content("hi")
+    message.add_attachment(b"line one\nline two\n", maintype="text", subtype="csv", filename="items.csv", cte=cte)
+    _, attachments = _parse(message.as_bytes())
+    assert attachments == [("items.csv", "text/csv", b"line one\nline two\n")]
@@ -0,0 +1,76 @@
+import asyncio
+import importlib
+
+import pytest
+
+from ses_eml_save import llm_client, metrics, ocr_cache, pdf_text
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ocr_cache, "OCR_CACHE_PATH", str(tmp_path / "ocr_cache.sqlite3"))
+    monkeypatch.setattr(ocr_cache, "OCR_CACHE_ENABLED", True)
+    monkeypatch.setattr(ocr_cache, "OCR_CACHE_SHARED", False)
+    monkeypatch.setattr(ocr_cache, "_conn", None)
+    yield ocr_cache
+    if ocr_cache._conn is not None:
+        ocr_cache._conn.close()
+
+
+def _namespace_with(monkeypatch, module, name, value):
+    monkeypatch.setattr(module, name, value)
+    return importlib.reload(ocr_cache).CACHE_NAMESPACE
+
+
+@pytest.fixture
+def reload_cache(monkeypatch):
+    yield
+    # 先恢复配置再重新加载，避免修改后的命名空间留给后续测试
+    monkeypatch.undo()
+    importlib.reload(ocr_cache)
+
+
+def test_round_trip_and_metrics(cache):
+    before = metrics.snapshot()
+    assert asyncio.run(cache.get_cached_ocr("abc")) is None
+    asyncio.run(cache.put_cached_ocr("abc", "Invoice 42", '{"invoice_number": "42"}'))
+    assert asyncio.run(cache.get_cached_ocr("abc")) == {"ocr": "Invoice 42", "fields": '{"invoice_number": "42"}'}
+    after = metrics.snapshot()
+    assert after.get("ocr_cache_hits", 0) - before.get("ocr_cache_hits", 0) == 1
+    assert after.get("ocr_cache_misses", 0) - before.get("ocr_cache_misses", 0) == 1
+
+
+def test_entries_are_encrypted_at_rest(cache):
+    asyncio.run(cache.put_cached_ocr("abc", "secret invoice text", ""))
+    stored = cache._conn.execute("SELECT ocr FROM ocr_cache").fetchone()[0]
+    assert "secret invoice text" not in stored
+
+
+def test_disabled_cache_is_a_no_op(cache, monkeypatch):
+    monkeypatch.setattr(cache, "OCR_CACHE_ENABLED", False)
+    asyncio.run(cache.put_cached_ocr("abc", "text", ""))
+    assert asyncio.run(cache.get_cached_ocr("abc")) is None
+    assert cache._conn is None
+
+
+def test_eviction_keeps_cache_under_limit(cache, monkeypatch):
+    monkeypatch.setattr(cache, "OCR_CACHE_MAX_BYTES", 2000)
+    monkeypatch.setattr(cache, "_EVICT_EVERY", 1)
+    for index in range(20):
+        asyncio.run(cache.put_cached_ocr(f"sha{index}", "x" * 200, ""))
+    total = cache._conn.execute("SELECT SUM(size) FROM ocr_cache").fetchone()[0]
+    assert total <= 2000
+    assert asyncio.run(cache.get_cached_ocr("sha19")) is not None
+
+
+@pytest.mark.parametrize("module, name, value", [
+    (llm_client, "PROMPT_VERSION", -1),
+    (llm_client, "MODEL", "another-model"),
+    (llm_client, "OCR_PIPELINE_MODE", "combined-test"),
+    (llm_client, "OCR_COMBINED_INCLUDE_TEXT", not llm_client.OCR_COMBINED_INCLUDE_TEXT),
+    (pdf_text, "PDF_TEXT_LAYER_ENABLED", not pdf_text.PDF_TEXT_LAYER_ENABLED),
+    (pdf_text, "PDF_OCR_ENGINE", "native"),
+])
+def test_namespace_changes_with_pipeline_config(monkeypatch, reload_cache, module, name, value):
+    baseline = importlib.reload(ocr_cache).CACHE_NAMESPACE
+    assert _namespace_with(monkeypatch, module, name, value) != baseline
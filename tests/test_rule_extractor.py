@@ -0,0 +1,120 @@
+import json
+import asyncio
+
+import pytest
+
+from ses_eml_save import rule_extractor
+from ses_eml_save.rule_extractor import build_template, parse_amount, parse_currency, parse_date, rule_extract
+
+
+APPLE_RECEIPT = """Apple
+One Apple Park Way, Cupertino
+Order Number: W123456789
+Invoice Date: March 5, 2025
+Total: US$ 19.99
+"""
+
+UBER_RECEIPT = """Uber
+Thanks for riding, Alex
+Trip ID: 8f2e1c
+Total: US$ 23.40
+Paid with Apple Pay
+"""
+
+
+@pytest.fixture
+def apple_template(monkeypatch):
+    record = {
+        "seller": "Apple",
+        "buyer": "Alex",
+        "address": "One Apple Park Way",
+        "category": "Software",
+        "currency": "USD",
+        "invoice_number": "W123456789",
+        "invoice_date": "2025-03-05",
+        "invoice_total": 19.99,
+    }
+    template = build_template(APPLE_RECEIPT, record)
+
+    async def user_templates(user_id):
+        return [template]
+
+    monkeypatch.setattr(rule_extractor, "_user_templates", user_templates)
+    return template
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Invoice date: June 23, 2025", "2025-06-23"),
+    ("日期：2025年6月3日", "2025-06-03"),
+    ("Date: 23/06/2025", "2025-06-23"),
+    ("Date 03/04/2025", None),
+])
+def test_parse_date(text, expected):
+    assert parse_date(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("$1,234.56", 1234.56),
+    ("1.234,56 EUR", 1234.56),
+    ("Total 12", 12.0),
+    ("1,234", None),
+])
+def test_parse_amount(text, expected):
+    assert parse_amount(text) == expected
+
+
+def test_parse_currency_leaves_ambiguous_symbols_to_llm():
+    assert parse_currency("Total US$ 10") == "USD"
+    assert parse_currency("Total $10") is None
+    assert parse_currency("€10 or £8") is None
+
+
+def test_template_matches_seller_in_header(apple_template):
+    text = APPLE_RECEIPT.replace("W123456789", "W987654321").replace("19.99", "42.00")
+    fields, defaults, personalized = asyncio.run(rule_extract(text, "u1"))
+    assert personalized
+    assert defaults == {}
+    assert fields["invoice_number"] == "W987654321"
+    assert fields["invoice_total"] == 42.0
+    assert fields["seller"] == "Apple"
+    assert set(fields) == set(rule_extractor.ALL_FIELDS)
+
+
+def test_template_ignores_seller_mentioned_in_payment_line(apple_template):
+    fields, defaults, personalized = asyncio.run(rule_extract(UBER_RECEIPT, "u1"))
+    assert not personalized
+    assert defaults == {}
+    assert "seller" not in fields
+
+
+def test_template_requires_whole_word_match(apple_template):
+    text = UBER_RECEIPT.replace("Uber", "Applebee's Grill").replace("Paid with Apple Pay\n", "")
+    _, _, personalized = asyncio.run(rule_extract(text, "u1"))
+    assert not personalized
+
+
+def test_unconfirmed_template_only_provides_defaults(apple_template):
+    # 卖家名称匹配但版式不同：标签字段取不到值时，卖家信息不能让字段提取跳过 LLM
+    text = "Apple\nReceipt 55\nAmount: 5.00\n"
+    fields, defaults, personalized = asyncio.run(rule_extract(text, "u1"))
+    assert personalized
+    assert "seller" not in fields
+    assert defaults["seller"] == "Apple"
+
+
+def test_extract_fields_asks_llm_when_template_is_unconfirmed(apple_template, monkeypatch):
+    from ses_eml_save import ocr
+
+    requested = []
+
+    async def fake_llm(text, fields=None):
+        requested.append(fields)
+        return json.dumps({"seller": "Apple Retail", "buyer": None})
+
+    monkeypatch.setattr(ocr, "extract_fields_from_ocr", fake_llm)
+    result, personalized = asyncio.run(ocr.extract_fields("Apple\nReceipt 55\nAmount: 5.00\n", "u1"))
+    fields = json.loads(result)
+    assert requested and "seller" in requested[0]
+    assert fields["seller"] == "Apple Retail"
+    assert fields["buyer"] == "Alex"
+    assert personalized